@@ -0,0 +1,86 @@
+"""测量响应压缩的 CPU 开销和节省的字节数
+
+用法：
+    python benchmarks/bench_compression.py --rows 1000 --output compression.json
+    python benchmarks/bench_compression.py --page-sizes 20,100,1000 --repeat 50
+    python benchmarks/bench_compression.py --compare compression.json --threshold 0.2
+
+先在临时数据库中写入 N 部电影，取得主页（每页不同条目数）、流式主页和 /api/movies 未压缩的响应内容，
+再按不同的 gzip 级别和 brotli 质量（需要安装 brotli）分别压缩，统计压缩后大小、压缩率、
+每个响应的 CPU 耗时和每毫秒 CPU 节省的字节数。流式主页按模板产生的原始分块逐块压缩，与线上行为一致。
+传入 --compare 时与之前的结果比较，CPU 耗时或压缩后大小变差超过阈值则以非零状态退出。
+"""
+import argparse
+import time
+
+from common import PASSWORD, USERNAME, add_output_arguments, finish, setup_app
+
+
+def collect_bodies(app, page_sizes):
+    """返回 {名称: 分块列表}；非流式响应只有一块"""
+    client = app.test_client()
+    client.post('/login', data={'username': USERNAME, 'password': PASSWORD})  # 登录后每行都有编辑和删除按钮
+    bodies = {}
+    for size in page_sizes:
+        app.config['WATCHLIST_PER_PAGE'] = size
+        bodies['index_%d' % size] = [client.get('/').get_data()]
+    app.config['WATCHLIST_STREAM_INDEX'] = True
+    response = client.get('/')
+    bodies['index_stream'] = [chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+                              for chunk in response.response]
+    response.close()
+    app.config['WATCHLIST_STREAM_INDEX'] = False
+    bodies['api_100'] = [client.get('/api/movies?limit=100').get_data()]
+    return bodies
+
+
+def settings():
+    from watchlist.compression import brotli
+    levels = [('gzip', 'WATCHLIST_COMPRESS_LEVEL', level) for level in (1, 6, 9)]
+    if brotli is not None:
+        levels += [('br', 'WATCHLIST_COMPRESS_BROTLI_QUALITY', quality) for quality in (1, 4, 11)]
+    return levels
+
+
+def measure(app, chunks, encoding, key, level, repeat):
+    from watchlist.compression import compress, compress_chunks
+
+    app.config[key] = level
+    original = sum(len(chunk) for chunk in chunks)
+    started = time.process_time()
+    for _ in range(repeat):
+        if len(chunks) == 1:
+            compressed = len(compress(chunks[0], encoding))
+        else:
+            compressed = sum(len(data) for data in compress_chunks(iter(chunks), encoding))
+    cpu_ms = (time.process_time() - started) * 1000 / repeat
+    return {
+        'original_bytes': original,
+        'compressed_bytes': compressed,
+        'ratio': round(compressed / float(original), 3),
+        'cpu_ms': round(cpu_ms, 3),
+        'saved_bytes_per_cpu_ms': round((original - compressed) / cpu_ms) if cpu_ms else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure compression CPU cost against bytes saved.')
+    parser.add_argument('--rows', type=int, default=1000, help='Movies to seed.')
+    parser.add_argument('--page-sizes', default='20,100,1000', help='Comma-separated index page sizes.')
+    parser.add_argument('--repeat', type=int, default=20, help='Compressions per measurement.')
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    app, _, _ = setup_app(args.rows, {'WATCHLIST_COMPRESS': False})  # 取未压缩的内容，压缩在下面单独计时
+    with app.app_context():
+        bodies = collect_bodies(app, [int(size) for size in args.page_sizes.split(',')])
+        results = {}
+        for name, chunks in bodies.items():
+            results[name] = dict(('%s-%d' % (encoding, level), measure(app, chunks, encoding, key, level, args.repeat))
+                                 for encoding, key, level in settings())
+    current = {'rows': args.rows, 'repeat': args.repeat, 'results': results}
+    finish(args, current, lower=('cpu_ms', 'compressed_bytes'))
+
+
+if __name__ == '__main__':
+    main()
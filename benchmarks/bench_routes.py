@@ -0,0 +1,170 @@
+"""对各个路由做负载和延迟测试
+
+用法：
+    python benchmarks/bench_routes.py --rows 100000 --requests 500 --output after.json
+    python benchmarks/bench_routes.py --rows 100000 --compare before.json --threshold 0.2
+
+先在临时数据库中写入 N 部电影，再分别用 app.test_client()（进程内）和多线程 WSGI 服务器（真实 HTTP）
+请求 /、/movie/edit/<id>、/movie/delete/<id> 和 /login，统计吞吐量、p50/p95/p99 延迟、
+每个请求的 SQL 查询数和进程的峰值内存。结果保存为 JSON，传入 --compare 时与之前的结果比较，
+延迟或吞吐量变差超过阈值则以非零状态退出，可用于 CI 检查性能回退。
+任何请求返回 2xx/3xx 以外的状态码（错误页面通常很快，会让结果看起来变好）时同样以非零状态退出。
+"""
+import argparse
+import http.client
+import logging
+import resource
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from urllib.parse import urlencode
+
+from common import PASSWORD, USERNAME, add_output_arguments, finish, setup_app
+
+DELETE_IDS = count(1)  # 两种模式共用，保证每次删除的都是还存在的电影
+
+
+class QueryCounter(object):
+    """统计执行的 SQL 语句数，基准测试在同一进程内运行服务器，所以可以直接监听 engine 事件"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def summarize(latencies, statuses, elapsed, queries):
+    errors = {}
+    for status in statuses:
+        if not 200 <= status < 400:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+    latencies = sorted(latencies)
+    cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': len(latencies),
+        'throughput': round(len(latencies) / elapsed, 2),  # 每秒请求数
+        'p50_ms': round(cuts[49] * 1000, 3),
+        'p95_ms': round(cuts[94] * 1000, 3),
+        'p99_ms': round(cuts[98] * 1000, 3),
+        'queries_per_request': round(queries / float(len(latencies)), 2),
+        'errors': errors,  # {状态码: 次数}，只统计 2xx/3xx 以外的响应
+    }
+
+
+def route_requests(rows):
+    """每个路由的请求生成器，返回 (method, path, form)；删除请求每次删除不同的电影"""
+    return {
+        'index': lambda: ('GET', '/', None),
+        'edit': lambda: ('GET', '/movie/edit/%d' % (rows // 2 or 1), None),
+        'delete': lambda: ('POST', '/movie/delete/%d' % next(DELETE_IDS), None),
+        'login': lambda: ('POST', '/login', {'username': USERNAME, 'password': PASSWORD}),
+    }
+
+
+def bench_test_client(app, counter, rows, total):
+    client = app.test_client()
+    client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+    results = {}
+    for route, make_request in route_requests(rows).items():
+        latencies, statuses = [], []
+        queries = counter.count
+        started = time.perf_counter()
+        for _ in range(total):
+            method, path, form = make_request()
+            t = time.perf_counter()
+            response = client.open(path, method=method, data=form)
+            latencies.append(time.perf_counter() - t)
+            statuses.append(response.status_code)
+        results[route] = summarize(latencies, statuses, time.perf_counter() - started, counter.count - queries)
+    return results
+
+
+def bench_server(app, counter, rows, total, threads):
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # 不输出每个请求的访问日志
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+    local = threading.local()
+
+    def request(method, path, form):
+        if not hasattr(local, 'conn'):  # 每个线程保持一个长连接，并先登录拿到会话 cookie
+            local.conn = http.client.HTTPConnection('127.0.0.1', port)
+            local.cookie = ''
+            send('POST', '/login', {'username': USERNAME, 'password': PASSWORD})
+        t = time.perf_counter()
+        response = send(method, path, form)
+        return time.perf_counter() - t, response.status
+
+    def send(method, path, form):
+        body = urlencode(form) if form else None
+        headers = {'Cookie': local.cookie, 'Content-Type': 'application/x-www-form-urlencoded'}
+        local.conn.request(method, path, body=body, headers=headers)
+        response = local.conn.getresponse()
+        response.read()
+        if response.getheader('Set-Cookie'):  # 会话内容（如 flash 消息）变化时服务器会更新 cookie
+            local.cookie = response.getheader('Set-Cookie').split(';', 1)[0]
+        return response
+
+    results = {}
+    lock = threading.Lock()
+    try:
+        for route, make_request in route_requests(rows).items():
+            queries = counter.count
+            started = time.perf_counter()
+
+            def one(_):
+                with lock:  # 生成器不是线程安全的
+                    args = make_request()
+                return request(*args)
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                latencies, statuses = zip(*pool.map(one, range(total)))
+            results[route] = summarize(latencies, statuses, time.perf_counter() - started, counter.count - queries)
+    finally:
+        server.shutdown()
+    return results
+
+
+def request_errors(current):
+    """返回有非 2xx/3xx 响应的路由列表"""
+    return ['HTTP ERROR %s %s: %s' % (mode, route, ', '.join('%s x%d' % item for item in sorted(stats['errors'].items())))
+            for mode, routes in current['results'].items() for route, stats in routes.items() if stats['errors']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the watchlist routes.')
+    parser.add_argument('--rows', type=int, default=1000, help='Movies to seed, e.g. 1000, 100000, 1000000.')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per route and mode.')
+    parser.add_argument('--threads', type=int, default=8, help='Client threads for the WSGI server run.')
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    # 删除请求会消耗电影，两种模式各需要 requests 部
+    app, db, _ = setup_app(max(args.rows, args.requests * 2))
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+    current = {
+        'rows': args.rows,
+        'requests': args.requests,
+        'threads': args.threads,
+        'results': {
+            'test_client': bench_test_client(app, counter, args.rows, args.requests),
+            'wsgi_server': bench_server(app, counter, args.rows, args.requests, args.threads),
+        },
+    }
+    # Linux 上 ru_maxrss 的单位是 KiB
+    current['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+    finish(args, current, lower=('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request'), higher=('throughput',),
+           errors=request_errors(current))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""比较列表页面的两种取数方式：完整的 Movie ORM 实例和只读的 MovieRow
+
+用法：
+    python benchmarks/bench_rows.py --rows 100000 --output rows.json
+    python benchmarks/bench_rows.py --rows 100000 --compare rows.json --threshold 0.2
+
+先在临时数据库中写入 N 部电影，再分别用两种方式一次取出全部电影并渲染 index.html，
+统计取数和渲染耗时（多次运行取中位数）、取数后仍存活的内存块数（sys.getallocatedblocks）、
+每行占用的内存和取数过程中的峰值内存（tracemalloc）。ORM 实例的内存包括 identity map 和 InstanceState。
+"""
+import argparse
+import gc
+import statistics
+import sys
+import time
+import tracemalloc
+
+from common import add_output_arguments, finish, setup_app
+
+
+def loaders(db, user_id):
+    from watchlist.models import Movie, movie_row
+    return {
+        'orm': lambda: Movie.query.filter(Movie.user_id == user_id).order_by(Movie.id).all(),
+        'rows': lambda: db.session.query(movie_row).filter(Movie.user_id == user_id).order_by(Movie.id).all(),
+    }
+
+
+def measure(app, db, load, rows, runs):
+    from flask import render_template
+
+    load_times, render_times = [], []
+    for _ in range(runs):
+        db.session.expunge_all()  # 每次都重新加载，不复用 identity map 中的实例
+        gc.collect()
+        started = time.perf_counter()
+        items = load()
+        load_times.append(time.perf_counter() - started)
+        with app.test_request_context('/'):
+            started = time.perf_counter()
+            render_template('index.html', movies=items, total=len(items))
+            render_times.append(time.perf_counter() - started)
+        del items
+
+    # 内存单独测一次，tracemalloc 会让取数变慢，不能和计时放在一起
+    db.session.expunge_all()
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    items = load()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    retained = sys.getallocatedblocks() - blocks
+    del items
+    db.session.expunge_all()
+    return {
+        'load_ms': round(statistics.median(load_times) * 1000, 1),
+        'render_ms': round(statistics.median(render_times) * 1000, 1),
+        'retained_blocks': retained,
+        'blocks_per_row': round(retained / float(rows), 2),
+        'bytes_per_row': round(current / float(rows), 1),
+        'peak_mb': round(peak / 1024.0 / 1024.0, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare ORM instances with read-only rows for listing pages.')
+    parser.add_argument('--rows', type=int, default=100000, help='Movies to seed and load.')
+    parser.add_argument('--runs', type=int, default=3, help='Timed runs per path.')
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    app, db, user_id = setup_app(args.rows)
+    with app.app_context():
+        current = {
+            'rows': args.rows,
+            'runs': args.runs,
+            'results': dict((path, measure(app, db, load, args.rows, args.runs))
+                            for path, load in loaders(db, user_id).items()),
+        }
+    finish(args, current, lower=('load_ms', 'render_ms', 'bytes_per_row', 'peak_mb'))
+
+
+if __name__ == '__main__':
+    main()
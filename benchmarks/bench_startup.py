@@ -0,0 +1,90 @@
+"""测量冷启动耗时：导入包、create_app()、执行一次 flask initdb、worker 启动后处理第一个请求
+
+用法：
+    python benchmarks/bench_startup.py --runs 10 --output startup.json
+    python benchmarks/bench_startup.py --compare startup.json --threshold 0.2
+    python benchmarks/bench_startup.py --importtime 15
+
+每次测量都启动一个新的 Python 进程，统计包括解释器启动在内的总耗时（python -c pass 作为基线），
+结果保存为 JSON，传入 --compare 时与之前的结果比较，变慢超过阈值则以非零状态退出。
+--importtime 用 python -X importtime 列出导入 create_app() 时累计耗时最多的模块。
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import ROOT, add_output_arguments, finish
+
+FIRST_REQUEST = '''
+from watchlist import create_app
+app = create_app()
+from watchlist import db
+with app.app_context():
+    db.create_all()
+app.test_client().get('/')
+'''
+
+SCENARIOS = {
+    'interpreter': [sys.executable, '-c', 'pass'],
+    'import': [sys.executable, '-c', 'import watchlist'],
+    'create_app': [sys.executable, '-c', 'from watchlist import create_app; create_app()'],
+    'cli_initdb': [sys.executable, '-m', 'flask', '--app', 'watchlist', 'initdb'],
+    'worker_first_request': [sys.executable, '-c', FIRST_REQUEST],
+}
+
+
+def run_scenario(command, runs, env):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+    return {
+        'runs': runs,
+        'median_ms': round(statistics.median(timings) * 1000, 1),
+        'min_ms': round(min(timings) * 1000, 1),
+    }
+
+
+def import_times(env, top):
+    """返回 (累计微秒, 模块名) 列表，只看 create_app() 直接或间接导入的顶层包"""
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'from watchlist import create_app; create_app()'],
+                            cwd=ROOT, env=env, check=True, stderr=subprocess.PIPE, text=True).stderr
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = len(name) - len(name.lstrip(' '))
+        if depth <= 3:  # 只保留顶层导入，子模块的耗时已计入其中
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure watchlist cold-start time.')
+    parser.add_argument('--runs', type=int, default=5, help='Processes started per scenario.')
+    add_output_arguments(parser)
+    parser.add_argument('--importtime', type=int, metavar='N', help='List the N slowest imports and exit.')
+    args = parser.parse_args()
+
+    env = dict(os.environ, DATABASE_FILE=os.path.join(tempfile.mkdtemp(), 'startup.db'))
+    if args.importtime:
+        for cumulative, name in import_times(env, args.importtime):
+            print('%8.1f ms  %s' % (cumulative / 1000.0, name))
+        return
+
+    current = {
+        'runs': args.runs,
+        'results': dict((name, run_scenario(command, args.runs, env)) for name, command in SCENARIOS.items()),
+    }
+    finish(args, current, lower=('median_ms',))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""基准测试脚本共用的部分：准备带数据的临时数据库、--output/--compare/--threshold 参数和回退检查"""
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+
+def setup_app(rows, config=None, chunk=10000):
+    """在临时数据库中创建一个用户并写入 rows 部电影，返回 (app, db, user_id)
+
+    配置在 create_app() 时读取，所以要先设置 DATABASE_FILE；config 是额外的配置项
+    """
+    os.environ['DATABASE_FILE'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    from watchlist import create_app, db
+    from watchlist.models import Movie, User
+
+    app = create_app(dict({'TESTING': True}, **(config or {})))
+    with app.app_context():
+        db.create_all()
+        user = User(name='Bench', username=USERNAME)
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+        insert = Movie.__table__.insert()
+        for start in range(0, rows, chunk):
+            with db.engine.begin() as conn:
+                conn.execute(insert, [{'title': 'Movie %d' % i, 'year': 1900 + i % 120, 'user_id': user.id}
+                                      for i in range(start, min(start + chunk, rows))])
+        user_id = user.id
+    return app, db, user_id
+
+
+def add_output_arguments(parser):
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Baseline JSON file to check for regressions.')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed relative regression (0.2 = 20%%).')
+
+
+def flatten(results, prefix=''):
+    """把 results 中嵌套的字典展开成 (名称, 指标字典) 列表，含有非字典值的一层为指标"""
+    items = []
+    for name, value in results.items():
+        if all(isinstance(child, dict) for child in value.values()):
+            items.extend(flatten(value, prefix + name + ' '))
+        else:
+            items.append((prefix + name, value))
+    return items
+
+
+def compare(current, baseline, threshold, lower=(), higher=()):
+    """返回变差超过阈值的指标列表：lower 中的指标越小越好，higher 中的越大越好"""
+    old_results = dict(flatten(baseline.get('results', {})))
+    failures = []
+    for name, stats in flatten(current['results']):
+        old = old_results.get(name)
+        if not old:
+            continue
+        for key in lower:
+            if old.get(key) and stats[key] > old[key] * (1 + threshold):
+                failures.append('%s %s: %s -> %s' % (name, key, old[key], stats[key]))
+        for key in higher:
+            if key in old and stats[key] < old[key] * (1 - threshold):
+                failures.append('%s %s: %s -> %s' % (name, key, old[key], stats[key]))
+    return failures
+
+
+def finish(args, current, lower=(), higher=(), errors=()):
+    """输出结果，按 --output 保存，按 --compare 检查回退；有回退或 errors 非空时以非零状态退出"""
+    print(json.dumps(current, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+
+    for error in errors:
+        print(error, file=sys.stderr)
+    failures = []
+    if args.compare:
+        with open(args.compare) as f:
+            failures = compare(current, json.load(f), args.threshold, lower, higher)
+        for failure in failures:
+            print('REGRESSION ' + failure, file=sys.stderr)
+    if errors or failures:
+        sys.exit(1)
@@ -1,28 +1,52 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
-from watchlist import app, db
-from watchlist.models import User, Movie
+from watchlist import create_app, db
+
+# 用测试配置创建 app：使用 SQLite 内存型数据库，不会读写开发用的 data.db
+app = create_app({
+    'TESTING': True,  # 开启测试模式，这样在出错时不会输出多余信息
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+    'WATCHLIST_TEMPLATE_CACHE_DIR': tempfile.mkdtemp(),
+})
+
+from watchlist.cache import LocalBackend, page_cache, user_cache
+from watchlist.models import User, Movie, MovieRow, bump_revision, movie_row
 from watchlist.commands import forge, initdb
+from watchlist.hashing import hash_pool
+from watchlist.profiling import sampler
+from watchlist.assets import manifest
+from watchlist.asgi import AsgiAdapter
+from watchlist.tenants import tenant_engines, tenant_scope
+from watchlist.templating import fragment_cache
+from watchlist.compression import compress_chunks
+from werkzeug.security import generate_password_hash
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from watchlist.sqlite import PROFILES, apply_pragmas, engine_options, retry_on_busy
 
 class WatchlistTestCase(unittest.TestCase):
 
     def setUp(self):
-        # 更改 app 参数
-        app.config.update(
-            TESTING=True,  # 开启测试模式，这样在出错时不会输出多余信息
-            SQLALCHEMY_DATABASE_URI='sqlite:///:memory:'  # 使用 SQLite 内存型数据库，不会干扰开发的数据库文件
-        )
-
         # 创建应用上下文
         self.app_context = app.app_context()
         self.app_context.push()
 
         # 创建数据库和表
         db.create_all()
+        user_cache.clear()  # 测试直接改写数据库，清掉上一个测试缓存的用户
+        page_cache.clear()
         # 创建测试数据，一个用户，一个电影条目
         user = User(name='Test', username='test')
         user.set_password('123')
-        movie = Movie(title='Test Movie Title', year='2024')
+        movie = Movie(title='Test Movie Title', year='2024', owner=user)
         # 使用 add_all() 方法一次添加多个模型类实例（即上面创建的user和movie），传入列表
         db.session.add_all([user, movie])  # 相当于把两句 db.session.add(user) db.session.add(movie) 合一起了
         db.session.commit()
@@ -37,10 +61,58 @@ class WatchlistTestCase(unittest.TestCase):
         # 移除应用上下文
         self.app_context.pop()
 
+    def create_app(self, **config):
+        """用额外的配置（如开启可选功能）另外创建一个 app，使用独立的内存数据库，写入与 setUp 相同的测试数据"""
+        other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:',
+                                WATCHLIST_TEMPLATE_CACHE_DIR='', **config))
+        with other.app_context():
+            db.create_all()
+            user = User(name='Test', username='test')
+            user.set_password('123')
+            db.session.add_all([user, Movie(title='Test Movie Title', year='2024', owner=user)])
+            db.session.commit()
+        return other
+
     # 测试程序实例是否存在
     def test_app_exist(self):
         self.assertIsNotNone(app)
 
+    # 测试应用工厂每次创建独立的实例，可选功能按配置注册
+    def test_create_app(self):
+        other = self.create_app(WATCHLIST_COMPRESS=False, WATCHLIST_INSTRUMENTATION=True)
+        self.assertIsNot(other, app)
+        self.assertIn('compression', app.blueprints)
+        self.assertNotIn('compression', other.blueprints)
+        self.assertNotIn('instrumentation', app.blueprints)
+        self.assertNotIn('profiling', app.blueprints)
+        self.assertIn('instrumentation', other.blueprints)
+
+        client = other.test_client()
+        client.post('/login', data=dict(username='test', password='123'))
+        client.post('/', data=dict(title='Other App', year='2001'))
+        self.assertIn('Other App', client.get('/').get_data(as_text=True))
+        self.assertNotIn('Other App', self.client.get('/').get_data(as_text=True))  # 数据库互不影响
+        response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    # 测试 fork 出的子进程不使用父进程的连接和线程
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork()')
+    def test_after_fork(self):
+        User.query.first().validate_password('123')  # 父进程中已有连接和散列线程池
+        parent_pool = db.engine.pool
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                fresh = hash_pool._executor is None and db.engine.pool is not parent_pool
+                with db.engine.connect() as conn:  # 内存数据库不能跨进程共享，子进程得到的是新的空数据库
+                    conn.execute(text('SELECT 1')).scalar()
+                code = 0 if fresh else 2
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
     # 测试程序是否处于测试模式
     def test_app_is_testing(self):
         self.assertTrue(app.config['TESTING'])
@@ -61,6 +133,224 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Test Movie Title', data)
         self.assertEqual(response.status_code, 200)
 
+    # 测试主页分页
+    def test_index_pagination(self):
+        app.config['WATCHLIST_PER_PAGE'] = 2
+        self.addCleanup(app.config.update, WATCHLIST_PER_PAGE=20)
+        db.session.add_all([Movie(user_id=1, title='Page Movie %d' % i, year='2024') for i in range(2, 6)])
+        db.session.commit()
+
+        # 第一页：id 1、2，只有下一页链接
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('5 Titles', data)
+        self.assertIn('Page Movie 2', data)
+        self.assertNotIn('Page Movie 3', data)
+        self.assertIn('?after=2', data)
+        self.assertNotIn('?before=', data)
+
+        # 下一页：id 3、4，前后都有链接
+        data = self.client.get('/?after=2').get_data(as_text=True)
+        self.assertIn('Page Movie 3', data)
+        self.assertIn('Page Movie 4', data)
+        self.assertNotIn('Page Movie 5', data)
+        self.assertIn('?before=3', data)
+        self.assertIn('?after=4', data)
+
+        # 上一页：回到 id 1、2
+        data = self.client.get('/?before=3').get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Page Movie 2', data)
+        self.assertNotIn('Page Movie 3', data)
+        self.assertNotIn('?before=', data)
+
+        # 超出 SQLite INTEGER 范围的游标返回 400，而不是绑定参数时出错
+        self.assertEqual(self.client.get('/?after=9223372036854775808').status_code, 400)
+        self.assertEqual(self.client.get('/?before=-9223372036854775809').status_code, 400)
+        self.assertIn('Page Movie 5', self.client.get('/?before=9223372036854775807').get_data(as_text=True))
+
+    # 测试列表页面使用的只读行
+    def test_movie_rows(self):
+        db.session.expunge_all()
+        rows = db.session.query(movie_row).filter(Movie.user_id == 1).all()
+        self.assertEqual(rows, [MovieRow(1, 'Test Movie Title', 2024)])
+        self.assertEqual(rows[0].title, 'Test Movie Title')
+        self.assertEqual(len(db.session.identity_map), 0)  # 没有加载 Movie 实例
+        self.assertEqual(db.session.execute(db.select(movie_row)).scalars().all(), rows)
+
+    # 测试主页流式输出
+    def test_index_stream(self):
+        app.config.update(WATCHLIST_STREAM_INDEX=True, WATCHLIST_PER_PAGE=2)
+        self.addCleanup(app.config.update, WATCHLIST_STREAM_INDEX=False, WATCHLIST_PER_PAGE=20)
+        db.session.add_all([Movie(user_id=1, title='Stream Movie %d' % i, year='2024') for i in range(2, 6)])
+        db.session.commit()
+
+        response = self.client.get('/')
+        self.assertTrue(response.is_streamed)
+        data = response.get_data(as_text=True)
+        self.assertIn('Test\'s Watchlist', data)
+        self.assertIn('5 Titles', data)
+        self.assertIn('Stream Movie 5', data)  # 流式模式输出完整列表，不分页
+        self.assertNotIn('?after=', data)
+
+    # 测试全文搜索
+    def test_search(self):
+        self.login()
+        self.client.post('/', data={'title': 'The Dark Knight', 'year': '2008'})
+        self.client.post('/', data={'title': 'Knight and Day', 'year': '2010'})
+
+        data = self.client.get('/search?q=knight').get_data(as_text=True)
+        self.assertIn('2 Results for', data)
+        self.assertIn('The Dark Knight', data)
+        self.assertIn('Knight and Day', data)
+        self.assertNotIn('Test Movie Title', data)
+
+        # 前缀匹配，编辑和删除后索引同步更新
+        self.client.post('/movie/edit/2', data={'title': 'Batman Begins', 'year': '2005'})
+        self.client.post('/movie/delete/3')
+        data = self.client.get('/search?q=bat').get_data(as_text=True)
+        self.assertIn('Batman Begins', data)
+        data = self.client.get('/search?q=knight').get_data(as_text=True)
+        self.assertIn('0 Results for', data)
+
+        # FTS5 语法字符不会导致出错
+        response = self.client.get('/search?q=%22AND%20(')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/search?q=a&page=9223372036854775808').status_code, 400)
+
+        # 只匹配当前用户清单中的标题，输入的词也不会匹配到 user_id 列
+        other = User(name='Other', username='other')
+        db.session.add(other)
+        db.session.commit()
+        db.session.add(Movie(title='Batman Returns', year='1992', user_id=other.id))
+        db.session.commit()
+        data = self.client.get('/search?q=batman').get_data(as_text=True)
+        self.assertIn('1 Results for', data)
+        self.assertNotIn('Batman Returns', data)
+        self.assertIn('0 Results for', self.client.get('/search?q=1').get_data(as_text=True))
+
+    # 测试 ASGI 入口
+    def test_asgi(self):
+        def call(method, path, chunks=(b'',), headers=(), query=b'', disconnect=False):
+            messages = [{'type': 'http.request', 'body': chunk, 'more_body': disconnect or i < len(chunks) - 1}
+                        for i, chunk in enumerate(chunks)]
+            if disconnect:
+                messages.append({'type': 'http.disconnect'})
+            sent = []
+
+            async def receive():
+                await asyncio.sleep(0)  # 模拟请求体分几次到达
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+            scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'root_path': '',
+                     'headers': list(headers), 'http_version': '1.1', 'scheme': 'http',
+                     'server': ('testserver', 80), 'client': ('127.0.0.1', 5000)}
+            asyncio.run(application(scope, receive, send))
+            return sent
+
+        application = AsgiAdapter(app)
+
+        sent = call('GET', '/')
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn(b'Test Movie Title', b''.join(m.get('body', b'') for m in sent[1:]))
+        self.assertFalse(sent[-1]['more_body'])
+
+        sent = call('POST', '/login', chunks=(b'username=test&', b'password=123'),
+                    headers=[(b'content-type', b'application/x-www-form-urlencoded')])
+        self.assertEqual(sent[0]['status'], 302)
+        cookie = dict(sent[0]['headers'])[b'set-cookie'].split(b';', 1)[0]
+        sent = call('GET', '/export.csv', headers=[(b'cookie', cookie)], query=b'gzip=1')
+        self.assertEqual(dict(sent[0]['headers'])[b'content-type'], b'application/gzip')
+        self.assertGreater(len(sent), 3)  # 流式响应分块发送
+
+        # 请求体没有发完就断开，不执行视图
+        sent = call('POST', '/', chunks=(b'year=2001&title=Truncat',), disconnect=True,
+                    headers=[(b'cookie', cookie), (b'content-type', b'application/x-www-form-urlencoded')])
+        self.assertEqual(sent, [])
+        self.assertIsNone(Movie.query.filter_by(title='Truncat').first())
+        db.session.rollback()  # 归还连接，下面的 lifespan.shutdown 会关闭内存数据库的连接
+
+        lifespan = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return lifespan.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+        asyncio.run(application({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+
+    # 测试导出
+    def test_export(self):
+        response = self.client.get('/export.csv')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.get_data(as_text=True), 'id,title,year\r\n1,Test Movie Title,2024\r\n')
+
+        response = self.client.get('/export.jsonl?gzip=1')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        row = json.loads(gzip.decompress(response.get_data()))
+        self.assertEqual(row, {'id': 1, 'title': 'Test Movie Title', 'year': 2024})
+
+        result = self.runner.invoke(args=['export', '--format', 'jsonl'])
+        self.assertEqual(json.loads(result.output)['title'], 'Test Movie Title')
+
+    # 测试 JSON API 的查询、分页和 ETag
+    def test_api_read(self):
+        db.session.add_all([Movie(user_id=1, title='Api Movie %d' % i, year=2000 + i) for i in range(2, 4)])
+        db.session.commit()
+
+        response = self.client.get('/api/movies?limit=2&fields=title')
+        data = response.get_json()
+        self.assertEqual(data['movies'], [{'title': 'Test Movie Title'}, {'title': 'Api Movie 2'}])
+        self.assertIsNone(data['prev'])
+        data = self.client.get(data['next']).get_json()
+        self.assertEqual(data['movies'], [{'title': 'Api Movie 3'}])
+        self.assertIsNone(data['next'])
+
+        response = self.client.get('/api/movies/1')
+        self.assertEqual(response.get_json(), {'id': 1, 'title': 'Test Movie Title', 'year': 2024})
+        etag = response.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))  # 强 ETag
+        response = self.client.get('/api/movies/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.assertEqual(self.client.get('/api/movies/99').status_code, 404)
+        self.assertEqual(self.client.get('/api/movies?fields=secret').status_code, 400)
+        response = self.client.get('/api/movies?before=9223372036854775808')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(), {'error': 'before is out of range.'})
+
+    # 测试 JSON API 的写操作
+    def test_api_write(self):
+        # 未登录时返回 401
+        response = self.client.post('/api/movies', json={'title': 'Api Movie', 'year': 2001})
+        self.assertEqual(response.status_code, 401)
+
+        self.login()
+        response = self.client.post('/api/movies', json={'title': 'Api Movie', 'year': 2001})
+        self.assertEqual(response.status_code, 201)
+        movie_id = response.get_json()['id']
+        response = self.client.post('/api/movies', json={'title': '', 'year': 2001})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.patch('/api/movies/%d' % movie_id, json={'year': '2002'})
+        self.assertEqual(response.get_json(), {'id': movie_id, 'title': 'Api Movie', 'year': 2002})
+
+        response = self.client.post('/api/movies/batch', json=[{'title': 'A', 'year': 1990}, {'title': 'B', 'year': 1991}])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.get_json()['movies']), 2)
+        # 其中一条不合格时全部不创建
+        response = self.client.post('/api/movies/batch', json=[{'title': 'C', 'year': 1992}, {'title': 'D'}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Movie.query.count(), 4)
+
+        response = self.client.delete('/api/movies/%d' % movie_id)
+        self.assertEqual(response.status_code, 204)
+        self.assertIsNone(db.session.get(Movie, movie_id))
+
     # 测试数据库，需要登入用户
     # 辅助方法，用于登入用户
     def login(self):
@@ -102,6 +392,19 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Item created.', data)
         self.assertIn('Invalid input.', data)
 
+        # 年份中的 Unicode 数字（如上标 ²）不是合法年份
+        response = self.client.post('/', data={'title': 'Unicode Year', 'year': '199\u00b2'}, follow_redirects=True)
+        self.assertIn('Invalid input.', response.get_data(as_text=True))
+        response = self.client.post('/movie/batch', data={'ids': ['1'], 'action': 'update', 'year': '\u0661\u0669\u0669\u0669'},
+                                    follow_redirects=True)
+        self.assertIn('Invalid input.', response.get_data(as_text=True))
+
+        # 缺少 year 或 title 字段时同样提示输入错误
+        response = self.client.post('/', data={'title': 'No Year'}, follow_redirects=True)
+        self.assertIn('Invalid input.', response.get_data(as_text=True))
+        response = self.client.post('/', data={'year': '2000'}, follow_redirects=True)
+        self.assertIn('Invalid input.', response.get_data(as_text=True))
+
     # 测试更新条目
     def test_update_item(self):
         # 登录测试账户
@@ -152,6 +455,37 @@ class WatchlistTestCase(unittest.TestCase):
         # self.assertIn('Item deleted.', data)
         self.assertNotIn('Test Movie Title', data)
 
+    # 测试批量修改和删除
+    def test_batch_items(self):
+        db.session.add_all([Movie(user_id=1, title='Batch Movie %d' % i, year='2000') for i in range(2, 6)])
+        db.session.commit()
+        self.assertEqual(self.client.post('/movie/batch', data={'ids': [2], 'action': 'delete'}).status_code, 302)
+        self.assertEqual(Movie.query.count(), 5)  # 未登录时不修改
+
+        self.login()
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('form="batch-form"', data)
+
+        # 共用的年份加上单独提交的标题
+        response = self.client.post('/movie/batch', data={'ids': [2, 3], 'action': 'update', 'year': '1999',
+                                                          'title-3': 'Renamed Movie'}, follow_redirects=True)
+        self.assertIn('2 items updated.', response.get_data(as_text=True))
+        self.assertEqual((db.session.get(Movie, 2).title, db.session.get(Movie, 2).year), ('Batch Movie 2', 1999))
+        self.assertEqual((db.session.get(Movie, 3).title, db.session.get(Movie, 3).year), ('Renamed Movie', 1999))
+
+        # 有一个条目不合格则全部不修改
+        response = self.client.post('/movie/batch', data={'ids': [4, 5], 'action': 'update', 'year': '2001',
+                                                          'year-5': '20'}, follow_redirects=True)
+        self.assertIn('Invalid input.', response.get_data(as_text=True))
+        self.assertEqual(db.session.get(Movie, 4).year, 2000)
+
+        response = self.client.post('/movie/batch', data={'ids': [1, 2, 4, 99], 'action': 'delete'},
+                                    follow_redirects=True)
+        self.assertIn('3 items deleted.', response.get_data(as_text=True))
+        self.assertEqual([movie.id for movie in Movie.query.order_by(Movie.id)], [3, 5])
+        data = self.client.get('/search?q=batch').get_data(as_text=True)  # 全文索引随批量删除同步更新
+        self.assertIn('1 Results for', data)
+
     # 测试登录保护
     def test_login_protect(self):
         # 未调用self.login(),即测试未登录情况下不该有的页面元素是否正确地未显示
@@ -215,6 +549,32 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Login success.', data)
         self.assertIn('Invalid input.', data)
 
+    # 测试登录成功后按新的散列参数重新计算密码散列
+    def test_login_rehash(self):
+        user = User.query.first()
+        user.password_hash = generate_password_hash('123', method='pbkdf2:sha256:1000')
+        db.session.commit()
+        self.login()
+        db.session.refresh(user)
+        self.assertTrue(user.password_hash.startswith('scrypt:'))
+        self.assertTrue(user.validate_password('123'))
+
+    # 测试散列线程池已满时登录快速返回 429
+    def test_login_busy(self):
+        app.config.update(WATCHLIST_HASH_WORKERS=1, WATCHLIST_HASH_QUEUE=0)
+        hash_pool.shutdown()
+        self.addCleanup(hash_pool.shutdown)
+        self.addCleanup(app.config.update, WATCHLIST_HASH_WORKERS=2, WATCHLIST_HASH_QUEUE=8)
+        hash_pool.run(len, '')  # 创建线程池
+        hash_pool._slots.acquire()  # 占用唯一的名额，模拟正在计算中的散列任务
+        response = self.client.post('/login', data={'username': 'test', 'password': '123'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertIn('Too Many Requests - 429', response.get_data(as_text=True))
+        hash_pool._slots.release()
+        response = self.client.post('/login', data={'username': 'test', 'password': '123'})
+        self.assertEqual(response.status_code, 302)
+
 # 测试登出
     def test_logout(self):
         # 先登录测试账户
@@ -255,6 +615,429 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Settings updated.', data)
         self.assertIn('Invalid input.', data)
 
+    # 测试用户缓存
+    def test_user_cache(self):
+        app.config['WATCHLIST_USER_CACHE'] = True
+        self.addCleanup(app.config.update, WATCHLIST_USER_CACHE=False)
+        user_cache.clear()
+
+        self.client.get('/')  # 未登录访客看第一个用户的清单，第一次请求未命中，查询后写入缓存
+        misses = user_cache.misses
+        self.assertGreater(misses, 0)
+        self.client.get('/')  # 第二次请求全部命中，不再查询
+        self.assertGreater(user_cache.hits, 0)
+        self.assertEqual(user_cache.misses, misses)
+
+        # settings 修改用户名后缓存失效，页面显示新名字
+        self.login()
+        response = self.client.post('/settings', data={'name': 'Cached Name'}, follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertIn('Cached Name', data)
+        self.assertEqual(User.query.first().name, 'Cached Name')
+        user_cache.get(1)
+        self.assertNotIn('password_hash', user_cache.backend.get('user:id:1'))  # 密码散列不写入缓存
+        db.session.expunge_all()
+        self.assertTrue(user_cache.get(1).validate_password('123'))  # 从缓存取出的用户需要时从数据库读取
+
+    # 测试基于清单版本号的条件请求
+    def test_conditional_get(self):
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        # 登录后 ETag 不同，编辑页面同样支持条件请求
+        self.login()
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        edit_etag = self.client.get('/movie/edit/1').headers['ETag']
+        response = self.client.get('/movie/edit/1', headers={'If-None-Match': edit_etag})
+        self.assertEqual(response.status_code, 304)
+
+        # 写操作后版本号变化，重新返回完整页面
+        self.client.post('/movie/edit/1', data={'title': 'Changed', 'year': '2020'})
+        self.client.get('/')  # 读掉 flash 消息
+        response = self.client.get('/movie/edit/1', headers={'If-None-Match': edit_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Changed', response.get_data(as_text=True))
+
+        # 重新构建静态资源后页面中的地址变了，没有写操作也不能再返回 304
+        response = self.client.get('/movie/edit/1')
+        edit_etag = response.headers['ETag']
+        app.config['WATCHLIST_ASSET_DIR'] = tempfile.mkdtemp()
+        self.addCleanup(app.config.update, WATCHLIST_ASSET_DIR=os.path.join(app.static_folder, 'dist'))
+        self.addCleanup(manifest.clear)
+        self.runner.invoke(args=['build-assets'])
+        response = self.client.get('/movie/edit/1', headers={'If-None-Match': edit_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('/assets/style.', response.get_data(as_text=True))
+
+    # 测试重建数据库后版本号从头开始，旧的 ETag 不会再匹配
+    def test_conditional_get_after_reset(self):
+        empty_etag = self.client.get('/').headers['ETag']  # 还没有写操作（版本号 0）
+        bump_revision()
+        db.session.commit()
+        etag = self.client.get('/').headers['ETag']
+        self.assertEqual(self.client.get('/', headers={'If-None-Match': etag}).status_code, 304)
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        db.session.add_all([User(name='New', username='new'), Movie(title='New Movie', year=2000, user_id=1)])
+        db.session.commit()
+        self.assertEqual(self.client.get('/', headers={'If-None-Match': empty_etag}).status_code, 200)
+        bump_revision()
+        db.session.commit()
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('New Movie', response.get_data(as_text=True))
+
+        # 旧数据库的 revision 表没有 generation 列，migrate-schema 添加
+        with db.engine.begin() as conn:
+            conn.execute(text('DROP TABLE revision'))
+            conn.execute(text('CREATE TABLE revision (id INTEGER PRIMARY KEY, revision INTEGER NOT NULL, '
+                              'updated_at DATETIME NOT NULL)'))
+        self.assertIn('Done.', self.runner.invoke(args=['migrate-schema']).output)
+        self.assertEqual(self.client.get('/').status_code, 200)
+
+    # 测试请求耗时统计
+    def test_instrumentation(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)  # 默认关闭
+        self.assertNotIn('Server-Timing', self.client.get('/').headers)
+
+        client = self.create_app(WATCHLIST_INSTRUMENTATION=True).test_client()
+        response = client.get('/')
+        timing = response.headers['Server-Timing']
+        self.assertIn('db;dur=', timing)
+        self.assertIn('render;dur=', timing)
+        self.assertIn('queries"', timing)
+
+        data = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('watchlist_requests_total{endpoint="main.index"}', data)
+        self.assertIn('watchlist_db_queries_total{endpoint="main.index"}', data)
+        self.assertIn('watchlist_user_cache_hits_total', data)
+
+    # 测试慢请求分析和 profile-report 命令
+    def test_profiling(self):
+        root = tempfile.mkdtemp()
+        other = self.create_app(WATCHLIST_PROFILE_DIR=root, WATCHLIST_PROFILE_SAMPLE=1, WATCHLIST_PROFILE_MAX_FILES=2)
+        client = other.test_client()
+        for _ in range(3):
+            client.get('/')
+        files = os.listdir(os.path.join(root, 'main.index'))
+        self.assertEqual(len(files), 2)  # 超出数量上限的旧文件被删除
+        self.assertTrue(all(name.endswith('.prof') for name in files))
+
+        # Python 3.12 起其他线程的 cProfile 正在记录时 enable() 抛出 ValueError，请求改用调用栈采样
+        import cProfile
+
+        class BusyProfile(cProfile.Profile):
+            def enable(self, *args, **kwargs):
+                raise ValueError('Another profiling tool is already active')
+        self.addCleanup(setattr, cProfile, 'Profile', cProfile.Profile)
+        cProfile.Profile = BusyProfile
+        other.config['WATCHLIST_PROFILE_SLOW_MS'] = 60000
+        self.assertEqual(client.get('/').status_code, 200)
+        self.assertEqual(sorted(os.listdir(os.path.join(root, 'main.index'))), sorted(files))
+        cProfile.Profile = BusyProfile.__bases__[0]
+
+        # 调用栈采样：登记当前线程后，后台线程定时记录它的调用栈
+        sampler.start(0.001)
+        sampler.begin()
+        time.sleep(0.05)
+        samples = sampler.end()
+        self.assertTrue(any('test_profiling' in stack for stack in samples))
+
+        result = self.runner.invoke(args=['profile-report', '--top', '5', '--dir', root])
+        self.assertIn('== main.index', result.output)
+        self.assertIn('-- cProfile, 2 requests', result.output)
+
+    # 测试带内容散列的静态资源
+    def test_build_assets(self):
+        output = tempfile.mkdtemp()
+        app.config['WATCHLIST_ASSET_DIR'] = output
+        self.addCleanup(app.config.update, WATCHLIST_ASSET_DIR=os.path.join(app.static_folder, 'dist'))
+        self.addCleanup(manifest.clear)
+        result = self.runner.invoke(args=['build-assets'])
+        self.assertIn('style.css -> style.', result.output)
+
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertNotIn('/static/style.css', data)
+        self.assertIn('/assets/images/totoro.', data)  # 模板中以 / 开头的文件名也能找到
+        href = data.split('rel="stylesheet" href="', 1)[1].split('"', 1)[0]
+
+        response = self.client.get(href, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        with open(os.path.join(app.static_folder, 'style.css'), 'rb') as f:
+            self.assertEqual(gzip.decompress(response.get_data()), f.read())
+        response = self.client.get(href)
+        self.assertNotIn('Content-Encoding', response.headers)
+        response = self.client.get(href.replace('/style.', '/images/totoro.').replace('.css', '.gif'),
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 404)  # 散列不对的地址不存在
+
+    # 测试预编译模板到字节码缓存
+    def test_compile_templates(self):
+        result = self.runner.invoke(args=['compile-templates', '--clear'])
+        self.assertIn('Compiled %d templates' % len(app.jinja_env.list_templates()), result.output)
+        self.assertTrue(os.listdir(app.config['WATCHLIST_TEMPLATE_CACHE_DIR']))
+
+    # 测试 base.html 中不变的部分每个版本只渲染一次
+    def test_template_fragments(self):
+        app.config['WATCHLIST_TEMPLATE_FRAGMENTS'] = True
+        self.addCleanup(app.config.update, WATCHLIST_TEMPLATE_FRAGMENTS=False)
+        fragment_cache.clear()
+        self.assertIn("<title>Test's Watchlist</title>", self.client.get('/').get_data(as_text=True))
+
+        # 不更新版本号直接改名，页头仍使用缓存的片段
+        db.session.execute(text("UPDATE user SET name = 'Renamed'"))
+        db.session.commit()
+        user_cache.clear()
+        self.assertIn("<title>Test's Watchlist</title>", self.client.get('/').get_data(as_text=True))
+
+        bump_revision()
+        db.session.commit()
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn("<title>Renamed's Watchlist</title>", data)
+        self.assertNotIn("Test's Watchlist", data)
+
+    # 测试响应压缩
+    def test_compression(self):
+        plain = self.client.get('/')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.get_data()), plain.get_data())
+        self.assertLess(response.content_length, plain.content_length)
+
+        # 小于下限的响应不压缩
+        app.config['WATCHLIST_COMPRESS_MIN_SIZE'] = 100000
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        app.config['WATCHLIST_COMPRESS_MIN_SIZE'] = 0
+        self.addCleanup(app.config.update, WATCHLIST_COMPRESS_MIN_SIZE=500)
+
+        # 已压缩的内容原样返回
+        response = self.client.get('/export.csv?gzip=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn(b'Test Movie Title', gzip.decompress(response.get_data()))
+        response = self.client.get('/static/images/avatar.png', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        response.close()
+
+        # 强 ETag 改为弱 ETag，带回后仍得到 304
+        response = self.client.get('/api/movies', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        self.assertEqual(json.loads(gzip.decompress(response.get_data()))['movies'][0]['title'], 'Test Movie Title')
+        response = self.client.get('/api/movies', headers={'Accept-Encoding': 'gzip',
+                                                           'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    # 测试流式响应逐块压缩
+    def test_compression_stream(self):
+        app.config['WATCHLIST_STREAM_INDEX'] = True
+        self.addCleanup(app.config.update, WATCHLIST_STREAM_INDEX=False)
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIsNone(response.content_length)
+        self.assertIn('Test Movie Title', gzip.decompress(response.get_data()).decode('utf-8'))
+
+        response = self.client.get('/export.jsonl', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn(b'"Test Movie Title"', gzip.decompress(response.get_data()))
+
+        # 第一块（页头）立即输出，之后的小块攒够 flush_size 才输出
+        produced = []
+
+        def chunks():
+            for chunk in ['<head>', 'a' * 10, 'b' * 10, 'c' * 10]:
+                produced.append(chunk)
+                yield chunk
+        stream = compress_chunks(chunks(), 'gzip', flush_size=25)
+        decoder = zlib.decompressobj(31)
+        self.assertEqual(decoder.decompress(next(stream)), b'<head>')
+        self.assertEqual(len(produced), 1)
+        self.assertEqual(decoder.decompress(next(stream)), b'a' * 10 + b'b' * 10 + b'c' * 10)
+        self.assertEqual(decoder.decompress(b''.join(stream)), b'')
+
+    # 测试增量同步的变更记录
+    def test_changes(self):
+        self.login()
+        self.client.post('/', data=dict(title='Feed Movie', year='2020'))
+        self.client.post('/movie/edit/2', data=dict(title='Feed Movie 2', year='2021'))
+        self.client.post('/movie/delete/1')
+        self.client.post('/movie/batch', data={'ids': ['2'], 'action': 'update', 'year': '2022'})
+        self.client.post('/settings', data=dict(name='Synced'))
+
+        feed = self.client.get('/changes?since=0').get_json()
+        self.assertFalse(feed['resync'])
+        self.assertFalse(feed['more'])
+        self.assertEqual([(c['kind'], c['op'], c['id']) for c in feed['changes']],
+                         [('movie', 'insert', 2), ('movie', 'update', 2), ('movie', 'delete', 1),
+                          ('movie', 'update', 2), ('user', 'update', 1)])
+        self.assertEqual(feed['changes'][3]['title'], 'Feed Movie 2')
+        self.assertEqual(feed['changes'][3]['year'], 2022)
+        self.assertNotIn('title', feed['changes'][2])  # 墓碑只有 id
+        self.assertEqual(feed['changes'][4]['name'], 'Synced')
+        self.assertEqual(feed['next'], feed['changes'][-1]['seq'])
+
+        # 从 next 继续没有新变更；limit 限制每次返回的条数
+        self.assertEqual(self.client.get('/changes?since=%d' % feed['next']).get_json()['changes'], [])
+        page = self.client.get('/changes?since=0&limit=2').get_json()
+        self.assertTrue(page['more'])
+        self.assertEqual(page['next'], feed['changes'][1]['seq'])
+
+        # 压缩后只保留每个对象最后一条记录，删除过期的墓碑；since 早于被删的墓碑时要求全量同步
+        result = self.runner.invoke(args=['compact-changes', '--days', '0'])
+        self.assertIn('Removed 2 superseded changes and 1 tombstones.', result.output)
+        compacted = self.client.get('/changes?since=%d' % page['next']).get_json()
+        self.assertTrue(compacted['resync'])
+        self.assertEqual(compacted['next'], feed['next'])
+        compacted = self.client.get('/changes?since=%d' % feed['changes'][2]['seq']).get_json()
+        self.assertFalse(compacted['resync'])
+        self.assertEqual([c['op'] for c in compacted['changes']], ['update', 'update'])
+        self.assertTrue(self.client.get('/changes?since=%d' % (feed['next'] + 100)).get_json()['resync'])
+        self.assertTrue(self.client.get('/changes?since=9223372036854775808').get_json()['resync'])
+
+    # 测试变更记录的长轮询
+    def test_changes_long_poll(self):
+        from watchlist.changes import notifier
+        from watchlist.models import Change, utcnow
+        app.config['WATCHLIST_CHANGES_POLL'] = 0.05
+        self.addCleanup(app.config.update, WATCHLIST_CHANGES_POLL=1)
+
+        started = time.monotonic()
+        feed = self.client.get('/changes?since=0&wait=0.2').get_json()
+        self.assertEqual(feed['changes'], [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+        def write():
+            time.sleep(0.1)
+            with app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(Change.__table__.insert().values(
+                        user_id=1, kind='movie', op='delete', object_id=1, created_at=utcnow()))
+            notifier.notify()
+        thread = threading.Thread(target=write)
+        thread.start()
+        started = time.monotonic()
+        feed = self.client.get('/changes?since=0&wait=10').get_json()
+        thread.join()
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([c['op'] for c in feed['changes']], ['delete'])
+
+        # 非有限的等待时间直接拒绝，不会一直等下去
+        for value in ('nan', 'inf'):
+            self.assertEqual(self.client.get('/changes?since=0&wait=' + value).status_code, 400)
+
+        # 同时等待的请求达到上限后，新的长轮询请求立即返回
+        app.config['WATCHLIST_CHANGES_MAX_WAITERS'] = 0
+        self.addCleanup(app.config.update, WATCHLIST_CHANGES_MAX_WAITERS=8)
+        started = time.monotonic()
+        feed = self.client.get('/changes?since=%d&wait=10' % feed['next']).get_json()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(feed['changes'], [])
+
+    # 测试未登录访客的整页缓存
+    def test_page_cache(self):
+        app.config['WATCHLIST_PAGE_CACHE'] = True
+        self.addCleanup(app.config.update, WATCHLIST_PAGE_CACHE=False)
+
+        self.client.get('/')
+        self.client.get('/')
+        self.assertEqual((page_cache.hits, page_cache.misses), (1, 1))
+        self.client.get('/?after=1')  # 查询字符串不同，单独缓存
+        self.assertEqual(page_cache.misses, 2)
+
+        # 页面带过期时间写入后端（Redis 后端按它设置过期，旧版本的页面不会一直留在 Redis 中）
+        ttls = []
+
+        class RecordingBackend(LocalBackend):
+            def set(self, key, value, ttl=None):
+                ttls.append(ttl)
+                super(RecordingBackend, self).set(key, value, ttl)
+        self.addCleanup(setattr, page_cache, '_backend', page_cache._backend)
+        page_cache._backend = RecordingBackend()
+        self.client.get('/')
+        self.assertEqual(ttls, [app.config['WATCHLIST_PAGE_CACHE_TTL']])
+
+        # 登录用户不使用缓存；创建条目后缓存失效，访客能看到新条目
+        self.login()
+        self.client.post('/', data={'title': 'Fresh Movie', 'year': '2024'})
+        self.client.get('/logout')
+        self.client.get('/')  # 有待显示的 flash 消息，不使用缓存
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Fresh Movie', data)
+        self.assertEqual(page_cache.hits, 1)
+
+        # 另一个进程执行 initdb --drop 后（本进程的缓存没有清空），新数据库达到相同版本号也不会命中旧页面
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        db.session.add(User(name='Reset', username='reset'))
+        db.session.commit()
+        db.session.add(Movie(title='Reset Movie', year=2000, user_id=1))  # 与上面的数据库一样只有一次写操作
+        bump_revision()
+        db.session.commit()
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Reset Movie', data)
+        self.assertNotIn('Fresh Movie', data)
+
+    # 测试 production 数据库配置下，写事务进行中其他连接仍能并发读取
+    def test_readers_not_blocked_by_writer(self):
+        def count_while_writing(profile):
+            path = os.path.join(tempfile.mkdtemp(), 'concurrency.db')
+            uri = 'sqlite:///' + path
+            engine = create_engine(uri, **engine_options(uri, pool_size=2))
+            apply_pragmas(engine, dict(PROFILES[profile], busy_timeout=100))
+            with engine.begin() as conn:
+                conn.execute(text('CREATE TABLE t (x INTEGER)'))
+                conn.execute(text('INSERT INTO t VALUES (1)'))
+            writer = engine.raw_connection()
+            writer.execute('BEGIN EXCLUSIVE')  # 写事务持有锁，尚未提交
+            writer.execute('INSERT INTO t VALUES (2)')
+            results = []
+
+            def read():
+                try:
+                    with engine.connect() as conn:
+                        results.append(conn.execute(text('SELECT count(*) FROM t')).scalar())
+                except OperationalError as e:
+                    results.append(str(e.orig))
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(5)
+            writer.rollback()
+            writer.close()
+            engine.dispose()
+            return results[0]
+
+        self.assertEqual(count_while_writing('production'), 1)  # WAL：读到写事务开始前的数据
+        self.assertEqual(count_while_writing('default'), 'database is locked')  # 默认的回滚日志模式：读被阻塞
+
+    # 测试数据库被锁时重试写操作
+    def test_retry_on_busy(self):
+        calls = []
+
+        @retry_on_busy
+        def write():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError('INSERT', {}, Exception('database is locked'))
+            return 'ok'
+        self.assertEqual(write(), 'ok')
+        self.assertEqual(len(calls), 3)
+
     # 上述是测试各个视图函数，还需测试自定义命令，即 @app.cli.command() 装饰的部分
     # 测试 initdb 命令
     def test_initdb_command(self):
@@ -268,6 +1051,168 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Mission Accomplished', result.output)
         self.assertNotEqual(Movie.query.count(), 0)  # 判断 forge 命令后数据库的 Movie 数据条数不为0
 
+    # 测试 migrate-schema 命令，把旧版字符串年份的表迁移为整数年份
+    def test_migrate_schema_command(self):
+        db.session.remove()
+        with db.engine.begin() as conn:
+            conn.execute(text('DROP TABLE movie'))
+            conn.execute(text('CREATE TABLE movie (id INTEGER PRIMARY KEY, title VARCHAR(60), year VARCHAR(4))'))
+            conn.execute(text("INSERT INTO movie (title, year) VALUES ('Old Movie', '1999'), ('Older Movie', '1972')"))
+            conn.execute(text('DROP TABLE change'))  # 旧版本还没有变更记录
+        result = self.runner.invoke(args=['migrate-schema', '--batch-size', '1'])
+        self.assertIn('Migrated 2 movies.', result.output)
+        self.assertIn('Assigned 2 movies to test.', result.output)  # 已有的电影分配给第一个用户
+        with db.engine.connect() as conn:
+            self.assertEqual(conn.execute(text('SELECT typeof(year) FROM movie')).scalars().all(), ['integer'] * 2)
+            indexes = conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars().all()
+        self.assertIn('ix_movie_year_id', indexes)
+        self.assertIn('ix_movie_user_id_id', indexes)
+        self.assertEqual(Movie.query.filter(Movie.year < 1990).one().title, 'Older Movie')
+
+        # 分配给用户的电影记为新增，从头同步的客户端能拿到完整清单
+        feed = self.client.get('/changes?since=0').get_json()
+        self.assertEqual([(c['op'], c['title']) for c in feed['changes']],
+                         [('insert', 'Old Movie'), ('insert', 'Older Movie')])
+
+        # 再次运行不会重复迁移
+        result = self.runner.invoke(args=['migrate-schema'])
+        self.assertIn('Movie table is up to date.', result.output)
+
+        # 已有 user_id 列的数据库第一次创建变更表时，现有的电影同样记为新增
+        with db.engine.begin() as conn:
+            conn.execute(text('DROP TABLE change'))
+        db.create_all()
+        feed = self.client.get('/changes?since=0').get_json()
+        self.assertEqual([(c['op'], c['id']) for c in feed['changes']], [('insert', 1), ('insert', 2)])
+
+    # 测试 add-user 命令和每个用户独立的清单
+    def test_multi_user(self):
+        result = self.runner.invoke(args=['add-user', '--username', 'other', '--name', 'Other',
+                                          '--password', '456'])
+        self.assertIn('Created user other.', result.output)
+        result = self.runner.invoke(args=['add-user', '--username', 'other', '--name', 'Again',
+                                          '--password', '456'])
+        self.assertNotEqual(result.exit_code, 0)
+
+        # 按用户名登录，只能看到和修改自己的条目
+        self.client.post('/login', data={'username': 'other', 'password': '456'})
+        self.client.post('/', data={'title': 'Other Movie', 'year': '2001'})
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn("Other's Watchlist", data)
+        self.assertIn('1 Titles', data)
+        self.assertIn('Other Movie', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertEqual(self.client.get('/movie/edit/1').status_code, 404)
+        self.assertEqual(self.client.post('/movie/delete/1').status_code, 404)
+        self.client.post('/movie/batch', data={'ids': [1], 'action': 'delete'})
+        self.assertIsNotNone(db.session.get(Movie, 1))
+        self.assertIn('0 Results', self.client.get('/search?q=test').get_data(as_text=True))
+
+        # 未登录访客看第一个用户的清单
+        self.client.get('/logout')
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn("Test's Watchlist", data)
+        self.assertNotIn('Other Movie', data)
+
+        result = self.runner.invoke(args=['export', '--username', 'other'])
+        self.assertEqual(result.output.splitlines(), ['id,title,year', '2,Other Movie,2001'])
+
+    # 测试按用户分库
+    def test_tenant_databases(self):
+        root = tempfile.mkdtemp()
+        app.config.update(WATCHLIST_TENANT_DIR=root, WATCHLIST_TENANT_ENGINES=1)
+        self.addCleanup(app.config.update, WATCHLIST_TENANT_DIR=None, WATCHLIST_TENANT_ENGINES=64)
+        self.addCleanup(tenant_engines.clear)
+        self.runner.invoke(args=['add-user', '--username', 'other', '--name', 'Other', '--password', '456'])
+        result = self.runner.invoke(args=['forge', '--tenant', 'test'])
+        self.assertIn('Mission Accomplished', result.output)
+        self.assertTrue(os.path.exists(os.path.join(root, '1.db')))
+
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('10 Titles', data)  # 访客看第一个用户数据库中的清单
+        self.assertNotIn('Test Movie Title', data)  # 主数据库中的电影不再显示
+
+        self.client.post('/login', data={'username': 'other', 'password': '456'})
+        self.client.post('/', data={'title': 'Tenant Movie', 'year': '2001'})
+        self.assertEqual(len(tenant_engines), 1)  # 最多保持一个 engine，第一个用户的已被关闭
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('1 Titles', data)
+        self.assertIn('Tenant Movie', data)
+        self.assertIn('1 Results', self.client.get('/search?q=tenant').get_data(as_text=True))
+        result = self.runner.invoke(args=['export'])  # 不指定用户时不会静默导出主数据库中空的 movie 表
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('--username is required', result.output)
+        result = self.runner.invoke(args=['export', '--username', 'other'])
+        self.assertIn('Tenant Movie', result.output)
+        with create_engine('sqlite:///' + os.path.join(root, '2.db')).connect() as conn:
+            self.assertEqual(conn.execute(text('SELECT title FROM movie')).scalars().all(), ['Tenant Movie'])
+        self.assertEqual(Movie.query.count(), 1)  # 主数据库没有变化
+
+        result = self.runner.invoke(args=['initdb', '--tenant', 'other', '--drop'])
+        self.assertIn('Initialized database for other.', result.output)
+        self.assertIn('0 Titles', self.client.get('/').get_data(as_text=True))
+
+        # 重建整个数据库时删除所有用户的数据库文件，新用户从 id 1 开始也不会打开旧用户的文件
+        self.client.get('/logout')
+        result = self.runner.invoke(args=['initdb', '--drop'])
+        self.assertIn('Removed 2 tenant databases.', result.output)
+        self.assertEqual(os.listdir(root), [])
+        self.runner.invoke(args=['add-user', '--username', 'new', '--name', 'New', '--password', '789'])
+        self.assertEqual(User.query.filter_by(username='new').one().id, 1)
+        self.assertIn('0 Titles', self.client.get('/').get_data(as_text=True))
+
+    # 测试删除用户后 id 不会被新用户重复使用
+    def test_user_id_not_reused(self):
+        db.session.add(User(name='Other', username='other'))
+        db.session.commit()
+        db.session.delete(User.query.filter_by(username='other').one())
+        db.session.commit()
+        db.session.add(User(name='Third', username='third'))
+        db.session.commit()
+        self.assertEqual(User.query.filter_by(username='third').one().id, 3)
+
+    # 测试事务进行中 engine 被挤出 LRU 时，会话仍使用原来的 engine
+    def test_tenant_engine_eviction(self):
+        app.config.update(WATCHLIST_TENANT_DIR=tempfile.mkdtemp(), WATCHLIST_TENANT_ENGINES=1)
+        self.addCleanup(app.config.update, WATCHLIST_TENANT_DIR=None, WATCHLIST_TENANT_ENGINES=64)
+        self.addCleanup(tenant_engines.clear)
+        with tenant_scope(1):
+            db.session.add(Movie(title='Pinned Movie', year=2001, user_id=1))
+            db.session.flush()
+            engine = db.session.get_bind(Movie)
+            tenant_engines.get(2)  # 另一个请求打开第二个用户的数据库，第一个用户的 engine 被淘汰
+            self.assertIs(db.session.get_bind(Movie), engine)
+            bump_revision()
+            db.session.commit()  # 只有一个连接写这个文件，不会等待自己持有的锁
+            self.assertEqual(engine.pool.checkedout(), 0)
+            tenant_engines.get(3)  # 连接已归还，被淘汰的 engine 这时才关闭
+            self.assertEqual(Movie.query.filter_by(title='Pinned Movie').count(), 1)
+
+    # 测试 rebuild-search 命令
+    def test_rebuild_search_command(self):
+        # 旧版本的索引没有 user_id 列，重建时按新结构重新创建
+        with db.engine.begin() as conn:
+            for name in ('insert', 'delete', 'update'):
+                conn.execute(text('DROP TRIGGER movie_fts_%s' % name))
+            conn.execute(text('DROP TABLE movie_fts'))
+            conn.execute(text("CREATE VIRTUAL TABLE movie_fts USING fts5(title, content='movie', content_rowid='id')"))
+        result = self.runner.invoke(args=['rebuild-search'])
+        self.assertIn('Search index rebuilt.', result.output)
+        data = self.client.get('/search?q=test').get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+
+    # 测试 import 命令，从标准输入导入 CSV 和 JSONL
+    def test_import_command(self):
+        result = self.runner.invoke(args=['import', '--chunk-size', '2'],
+                                    input='title,year\nAlien,1979\n,2000\nHeat,19x5\nHeat,1995\nUp,2009\n')
+        self.assertIn('Imported 3 movies, rejected 2 rows.', result.output)
+        self.assertEqual(Movie.query.filter_by(title='Heat').one().year, 1995)
+
+        result = self.runner.invoke(args=['import', '--format', 'jsonl'],
+                                    input='{"title": "Jaws", "year": 1975}\nnot json\n')
+        self.assertIn('Imported 1 movies, rejected 1 rows.', result.output)
+        self.assertEqual(Movie.query.count(), 5)
+
     # 测试生成管理员账户
     def test_admin_command(self):
         # 先清除测试的 User 数据库，再创建一个新表格
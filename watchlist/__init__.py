@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import threading
+import weakref
 
 from flask import Flask # 从 flask 包导入 Flask 类
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 
+from watchlist.sqlite import PROFILES, apply_pragmas, engine_options
+from watchlist.tenants import TenantSession
+
 # ...
 
 WIN = sys.platform.startswith('win')
@@ -14,27 +19,157 @@ if WIN:
 else:
     prefix = 'sqlite:////'
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'dev'
-# 把 app.root_path 添加到 os.path.dirname() 中，以便把文件定位到项目根目录
-app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(os.path.dirname(app.root_path), os.getenv('DATABASE_FILE', 'data.db'))
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# 扩展对象先创建，在 create_app() 中再与 app 绑定；models 等模块可以在 app 创建之前导入
+db = SQLAlchemy(session_options={'class_': TenantSession})  # 按用户分库时由 TenantSession 选择数据库
+login_manager = LoginManager()  # 实例化扩展类
+_apps = weakref.WeakSet()  # 本进程创建的 app，fork 之后要丢弃它们继承来的数据库连接
+_apps_lock = threading.Lock()
+_fork_hook = False
+
+
+def configure(app):
+    """从环境变量读取配置"""
+    app.config['SECRET_KEY'] = 'dev'
+    # 把 app.root_path 添加到 os.path.dirname() 中，以便把文件定位到项目根目录
+    app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(os.path.dirname(app.root_path), os.getenv('DATABASE_FILE', 'data.db'))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['WATCHLIST_PER_PAGE'] = int(os.getenv('WATCHLIST_PER_PAGE', 20))  # 主页每页显示的条目数
+    # 开启后主页以流式方式输出完整列表，按批从数据库游标读取，内存占用不随条目数增长
+    app.config['WATCHLIST_STREAM_INDEX'] = os.getenv('WATCHLIST_STREAM_INDEX', '0') == '1'
+    app.config['WATCHLIST_STREAM_BATCH'] = int(os.getenv('WATCHLIST_STREAM_BATCH', 500))  # 流式输出时每批读取的行数
+    app.config['WATCHLIST_API_MAX_PER_PAGE'] = int(os.getenv('WATCHLIST_API_MAX_PER_PAGE', 100))  # API 每页条目数上限
+    # 缓存用户记录，减少每次请求的查询；默认只在多个 worker 共享 Redis 缓存时开启，否则其他 worker 看不到改名
+    app.config['WATCHLIST_USER_CACHE'] = os.getenv(
+        'WATCHLIST_USER_CACHE', '1' if os.getenv('WATCHLIST_CACHE_REDIS_URL') else '0') == '1'
+    # 缓存未登录访客看到的整页 HTML，有写操作时失效；CLI 命令的写入只有使用共享的 Redis 缓存时才能让 Web 进程失效
+    app.config['WATCHLIST_PAGE_CACHE'] = os.getenv('WATCHLIST_PAGE_CACHE', '0') == '1'
+    app.config['WATCHLIST_PAGE_CACHE_SIZE'] = int(os.getenv('WATCHLIST_PAGE_CACHE_SIZE', 256))  # 进程内最多缓存的页面数
+    # Redis 中缓存页面的过期秒数：旧版本的页面不会被删除，只能靠过期清理（进程内缓存由 LRU 淘汰）
+    app.config['WATCHLIST_PAGE_CACHE_TTL'] = int(os.getenv('WATCHLIST_PAGE_CACHE_TTL', 3600))
+    # 密码散列的方法和参数，修改后已有用户会在下次登录成功时自动按新参数重新计算
+    app.config['WATCHLIST_HASH_METHOD'] = os.getenv('WATCHLIST_HASH_METHOD', 'scrypt')
+    app.config['WATCHLIST_HASH_WORKERS'] = int(os.getenv('WATCHLIST_HASH_WORKERS', 2))  # 计算密码散列的线程数
+    app.config['WATCHLIST_HASH_QUEUE'] = int(os.getenv('WATCHLIST_HASH_QUEUE', 8))  # 最多排队等待的散列任务数，超出时返回 429
+    # 设置后缓存存放在 Redis 中，多个 worker 进程共享同一份缓存
+    app.config['WATCHLIST_CACHE_REDIS_URL'] = os.getenv('WATCHLIST_CACHE_REDIS_URL')
+    # 开启后记录每个请求的 SQL 查询数与耗时、模板渲染耗时，输出 Server-Timing 头、日志，并提供 /metrics
+    app.config['WATCHLIST_INSTRUMENTATION'] = os.getenv('WATCHLIST_INSTRUMENTATION', '0') == '1'
+    # 慢请求分析：设置 WATCHLIST_PROFILE_DIR 后开启，分析结果按 endpoint 保存在该目录下，用 flask profile-report 汇总
+    app.config['WATCHLIST_PROFILE_DIR'] = os.getenv('WATCHLIST_PROFILE_DIR')
+    app.config['WATCHLIST_PROFILE_SAMPLE'] = int(os.getenv('WATCHLIST_PROFILE_SAMPLE', 0))  # 每 N 个请求随机用 cProfile 记录一次，0 为关闭
+    app.config['WATCHLIST_PROFILE_SLOW_MS'] = int(os.getenv('WATCHLIST_PROFILE_SLOW_MS', 500))  # 超过该耗时的请求保存调用栈采样，0 为关闭
+    app.config['WATCHLIST_PROFILE_INTERVAL_MS'] = int(os.getenv('WATCHLIST_PROFILE_INTERVAL_MS', 5))  # 调用栈采样间隔
+    app.config['WATCHLIST_PROFILE_MAX_FILES'] = int(os.getenv('WATCHLIST_PROFILE_MAX_FILES', 50))  # 每个 endpoint 最多保留的文件数
+    app.config['WATCHLIST_PROFILE_MAX_BYTES'] = int(os.getenv('WATCHLIST_PROFILE_MAX_BYTES', 100 * 1024 * 1024))  # 所有文件的总大小上限
+    # 静态资源：用 flask build-assets 构建带内容散列的文件后，模板中的静态文件地址自动改为构建结果，并允许浏览器永久缓存
+    app.config['WATCHLIST_ASSETS'] = os.getenv('WATCHLIST_ASSETS', '1') == '1'
+    app.config['WATCHLIST_ASSET_DIR'] = os.getenv('WATCHLIST_ASSET_DIR', os.path.join(app.static_folder, 'dist'))  # 构建输出目录
+    # 模板字节码缓存目录，多个 worker 共用，设为空字符串关闭；开启 WATCHLIST_TEMPLATE_FRAGMENTS 后 base.html 中不变的部分每个清单版本只渲染一次
+    app.config['WATCHLIST_TEMPLATE_CACHE_DIR'] = os.getenv('WATCHLIST_TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'jinja'))
+    app.config['WATCHLIST_BUILD_ID'] = os.getenv('WATCHLIST_BUILD_ID', '')  # 部署版本（如 git 提交号），变化后 ETag 和缓存的页面随之失效
+    app.config['WATCHLIST_TEMPLATE_FRAGMENTS'] = os.getenv('WATCHLIST_TEMPLATE_FRAGMENTS', '0') == '1'
+    # 响应压缩：文本类响应按浏览器支持的 br（需要安装 brotli）或 gzip 压缩，小于 WATCHLIST_COMPRESS_MIN_SIZE 字节的不压缩
+    app.config['WATCHLIST_COMPRESS'] = os.getenv('WATCHLIST_COMPRESS', '1') == '1'
+    app.config['WATCHLIST_COMPRESS_MIN_SIZE'] = int(os.getenv('WATCHLIST_COMPRESS_MIN_SIZE', 500))
+    app.config['WATCHLIST_COMPRESS_LEVEL'] = int(os.getenv('WATCHLIST_COMPRESS_LEVEL', 6))  # gzip 压缩级别 1-9，越高越省流量也越耗 CPU
+    app.config['WATCHLIST_COMPRESS_BROTLI_QUALITY'] = int(os.getenv('WATCHLIST_COMPRESS_BROTLI_QUALITY', 4))  # brotli 质量 0-11
+    # 增量同步 /changes：每次最多返回的变更数、长轮询最长等待秒数、等待期间查询数据库的间隔（发现其他进程的写入）
+    app.config['WATCHLIST_CHANGES_LIMIT'] = int(os.getenv('WATCHLIST_CHANGES_LIMIT', 500))
+    app.config['WATCHLIST_CHANGES_MAX_WAIT'] = float(os.getenv('WATCHLIST_CHANGES_MAX_WAIT', 30))
+    app.config['WATCHLIST_CHANGES_POLL'] = float(os.getenv('WATCHLIST_CHANGES_POLL', 1))
+    # 每个进程同时等待的长轮询请求数上限，每个等待的请求占用一个线程，超出上限的请求不等待，立即返回
+    app.config['WATCHLIST_CHANGES_MAX_WAITERS'] = int(os.getenv('WATCHLIST_CHANGES_MAX_WAITERS', 8))
+    app.config['WATCHLIST_ASGI_THREADS'] = int(os.getenv('WATCHLIST_ASGI_THREADS', 32))  # ASGI 模式下执行视图的线程数
+    # SQLite 连接参数：production 开启 WAL、设置缓存和锁等待时间，default 使用 SQLite 默认设置
+    app.config['WATCHLIST_DB_PROFILE'] = os.getenv('WATCHLIST_DB_PROFILE', 'production')
+    app.config['WATCHLIST_DB_POOL_SIZE'] = int(os.getenv('WATCHLIST_DB_POOL_SIZE', 5))  # 连接池保持的连接数
+    app.config['WATCHLIST_DB_RETRIES'] = int(os.getenv('WATCHLIST_DB_RETRIES', 5))  # 写操作遇到数据库被锁时的重试次数
+    # 按用户分库：设置目录后每个用户的清单保存在该目录下单独的 SQLite 文件中，主数据库只保存用户表
+    app.config['WATCHLIST_TENANT_DIR'] = os.getenv('WATCHLIST_TENANT_DIR')
+    app.config['WATCHLIST_TENANT_ENGINES'] = int(os.getenv('WATCHLIST_TENANT_ENGINES', 64))  # 同时保持打开的用户数据库数
+    app.config['WATCHLIST_TENANT_POOL_SIZE'] = int(os.getenv('WATCHLIST_TENANT_POOL_SIZE', 2))  # 每个用户数据库的连接池大小
+
+
+def create_app(config=None):
+    """应用工厂：每次调用都创建一个新的 app，传入的 config 在初始化数据库等扩展之前生效
+
+    视图、错误页面、命令等都是蓝本，在这里注册到 app 上；测试可以用不同的 config 创建多个互不影响的 app。
+    可选的功能（慢请求分析、请求统计、响应压缩）只在配置开启时才导入并注册，关闭时不增加任何请求钩子。
+    flask --app watchlist 会自动调用 create_app()。
+    """
+    app = Flask(__name__)
+    configure(app)
+    app.config.update(config or {})
+    # 连接池按最终的数据库地址选择，所以在应用 config 之后再计算
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'], app.config['WATCHLIST_DB_POOL_SIZE']))
+    db.init_app(app)  # 初始化扩展，传入上面的程序实例 app
+    with app.app_context():
+        apply_pragmas(db.engine, PROFILES[app.config['WATCHLIST_DB_PROFILE']])  # 每个新连接建立时执行 PRAGMA
+    login_manager.init_app(app)
+    app.context_processor(inject_user)
+
+    from watchlist import templating
+    templating.init_app(app)  # 要在其他代码访问 app.jinja_env 之前设置字节码缓存
 
-db = SQLAlchemy(app)  # 初始化扩展，传入上面的程序实例 app
-login_manager = LoginManager(app)  # 实例化扩展类
+    from watchlist import views, errors, commands, api, assets, changes
+    # after_request 按注册的相反顺序执行：压缩最后注册、最先执行，分析和统计记录的是压缩前的耗时
+    if app.config['WATCHLIST_INSTRUMENTATION']:
+        from watchlist import instrumentation
+        app.register_blueprint(instrumentation.bp)
+    if app.config['WATCHLIST_PROFILE_DIR']:
+        from watchlist import profiling
+        app.register_blueprint(profiling.bp)
+    for module in (views, errors, commands, api, assets, changes):
+        app.register_blueprint(module.bp)
+    if app.config['WATCHLIST_COMPRESS']:
+        from watchlist import compression
+        app.register_blueprint(compression.bp)
+
+    global _fork_hook
+    with _apps_lock:
+        if not _fork_hook and hasattr(os, 'register_at_fork'):  # 只有 POSIX 系统有 fork，Windows 上没有这个函数
+            os.register_at_fork(after_in_child=_after_fork)
+            _fork_hook = True
+        _apps.add(app)
+    return app
+
+
+def _after_fork():
+    """预先 fork 的服务器（gunicorn --preload 等）在子进程中调用：不能继续使用父进程的数据库连接和线程"""
+    from watchlist.changes import notifier
+    from watchlist.hashing import hash_pool
+    from watchlist.tenants import tenant_engines
+    for app in list(_apps):
+        with app.app_context():
+            db.engine.dispose(close=False)  # 丢弃继承来的连接而不关闭，父进程仍在使用它们
+    tenant_engines.reset()
+    hash_pool.reset()
+    notifier.reset()
+    profiling = sys.modules.get('watchlist.profiling')  # 没有开启慢请求分析时不会导入
+    if profiling is not None:
+        profiling.sampler.reset()
 
 @login_manager.user_loader
 def load_user(user_id):
-    from watchlist.models import User
-    user = User.query.get(int(user_id))
+    from watchlist.cache import user_cache
+    user = user_cache.get(int(user_id))
     return user
 
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
+
+def current_owner():
+    """当前请求显示谁的观影清单：登录用户看自己的，未登录访客看第一个用户（站点主人）的"""
+    from flask_login import current_user
+    from watchlist.cache import user_cache
+    if current_user.is_authenticated:
+        return current_user._get_current_object()
+    return user_cache.first()
+
+def current_owner_id():
+    owner = current_owner()
+    return owner.id if owner is not None else 0  # 还没有用户时不匹配任何条目
 
-@app.context_processor
 def inject_user():
-    from watchlist.models import User
-    user = User.query.first()
+    user = current_owner()
     return dict(user=user)
-
-from watchlist import views, errors, commands
\ No newline at end of file
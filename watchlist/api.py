@@ -0,0 +1,149 @@
+from functools import wraps
+
+from flask import Blueprint, abort, current_app, jsonify, request, url_for
+from flask_login import current_user
+
+from watchlist import db, current_owner_id
+from watchlist.models import Movie, movie_row, validate_movie, bump_revision, record_changes
+from watchlist.pagination import cursor_arg, keyset_page
+from watchlist.sqlite import retry_on_busy
+
+# JSON API，供脚本和移动端使用，URL 统一以 /api 开头
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+FIELDS = ('id', 'title', 'year')
+
+
+def api_login_required(func):
+    # 与 login_required 相同，但未登录时返回 401 JSON，而不是重定向到登录页面
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            abort(401)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def movie_to_dict(movie, fields=FIELDS):
+    return dict((field, getattr(movie, field)) for field in fields)
+
+
+def requested_fields():
+    """?fields=title,year 只返回指定的字段"""
+    fields = request.args.get('fields')
+    if not fields:
+        return FIELDS
+    fields = tuple(field.strip() for field in fields.split(','))
+    if not all(field in FIELDS for field in fields):
+        abort(400, 'Unknown field; choose from: %s.' % ', '.join(FIELDS))
+    return fields
+
+
+def movie_data(data):
+    """从请求的 JSON 中取出 title 和 year，使用与 index() 相同的校验规则"""
+    if not isinstance(data, dict):
+        abort(400, 'Expected a JSON object.')
+    title = data.get('title')
+    year = str(data.get('year', ''))
+    if not isinstance(title, str) or not validate_movie(title, year):
+        abort(400, 'Invalid input.')
+    return {'title': title, 'year': int(year)}
+
+
+@bp.after_request
+def add_etag(response):
+    # 强 ETag 取响应内容的哈希值；客户端带 If-None-Match 再次请求且内容未变时返回 304，不重复下载
+    if request.method == 'GET' and response.status_code == 200:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+@bp.errorhandler(400)
+@bp.errorhandler(401)
+@bp.errorhandler(404)
+def api_error(e):
+    return jsonify(error=e.description), e.code
+
+
+@bp.route('/movies')
+def list_movies():
+    fields = requested_fields()
+    limit = request.args.get('limit', current_app.config['WATCHLIST_PER_PAGE'], type=int)
+    limit = min(max(limit, 1), current_app.config['WATCHLIST_API_MAX_PER_PAGE'])
+    page = keyset_page(db.session.query(movie_row).filter(Movie.user_id == current_owner_id()), Movie.id, limit,
+                       before=cursor_arg('before'), after=cursor_arg('after'))
+    # 翻页链接保留 limit 和 fields 参数
+    args = dict((key, request.args[key]) for key in ('limit', 'fields') if key in request.args)
+    return jsonify(
+        movies=[movie_to_dict(movie, fields) for movie in page.items],
+        prev=url_for('api.list_movies', before=page.first_id, **args) if page.has_prev else None,
+        next=url_for('api.list_movies', after=page.last_id, **args) if page.has_next else None,
+    )
+
+
+@bp.route('/movies/<int:movie_id>')
+def get_movie(movie_id):
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_owner_id()).first_or_404()
+    return jsonify(movie_to_dict(movie, requested_fields()))
+
+
+@bp.route('/movies', methods=['POST'])
+@api_login_required
+@retry_on_busy
+def create_movie():
+    movie = Movie(user_id=current_user.id, **movie_data(request.get_json(silent=True)))
+    db.session.add(movie)
+    db.session.flush()
+    record_changes('insert', [movie])
+    bump_revision()
+    db.session.commit()
+    response = jsonify(movie_to_dict(movie))
+    response.status_code = 201
+    response.headers['Location'] = url_for('api.get_movie', movie_id=movie.id)
+    return response
+
+
+@bp.route('/movies/batch', methods=['POST'])
+@api_login_required
+@retry_on_busy
+def create_movies():
+    # 一次创建多部电影，任何一条不合格则全部不创建
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        abort(400, 'Expected a JSON array.')
+    movies = [Movie(user_id=current_user.id, **movie_data(item)) for item in items]
+    db.session.add_all(movies)
+    db.session.flush()
+    record_changes('insert', movies)
+    bump_revision()
+    db.session.commit()
+    return jsonify(movies=[movie_to_dict(movie) for movie in movies]), 201
+
+
+@bp.route('/movies/<int:movie_id>', methods=['PUT', 'PATCH'])
+@api_login_required
+@retry_on_busy
+def update_movie(movie_id):
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()
+    data = request.get_json(silent=True)
+    if request.method == 'PATCH' and isinstance(data, dict):
+        data = dict(movie_to_dict(movie, ('title', 'year')), **data)  # PATCH 只修改提交了的字段
+    for key, value in movie_data(data).items():
+        setattr(movie, key, value)
+    record_changes('update', [movie])
+    bump_revision()
+    db.session.commit()
+    return jsonify(movie_to_dict(movie))
+
+
+@bp.route('/movies/<int:movie_id>', methods=['DELETE'])
+@api_login_required
+@retry_on_busy
+def delete_movie(movie_id):
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()
+    db.session.delete(movie)
+    record_changes('delete', [movie])
+    bump_revision()
+    db.session.commit()
+    return '', 204
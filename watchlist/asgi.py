@@ -0,0 +1,161 @@
+"""ASGI 入口，用 ASGI 服务器运行：
+
+    uvicorn watchlist.asgi:application --workers 4
+
+连接由服务器的事件循环管理：空闲的长连接、慢速上传请求体的客户端只占用协程，
+请求体读完后才把请求交给有上限的线程池执行 Flask 视图，线程数由 WATCHLIST_ASGI_THREADS 设置。
+"""
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from watchlist import create_app, db
+from watchlist.tenants import tenant_engines
+
+
+class AsgiAdapter(object):
+    """把 Flask app 包装为 ASGI 程序，只支持 HTTP 和 lifespan"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.wsgi_app.config['WATCHLIST_ASGI_THREADS'],
+                                                        thread_name_prefix='asgi-worker')
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise RuntimeError('Unsupported ASGI scope type: %s' % scope['type'])
+        body = await read_body(receive)
+        if body is None:  # 客户端在请求体发送完之前断开，不能把不完整的请求交给视图处理
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.run_wsgi, scope, body, send, loop)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+        with self.wsgi_app.app_context():
+            db.engine.dispose()
+        tenant_engines.clear()
+
+    def run_wsgi(self, scope, body, send, loop):
+        """在线程池中执行：调用 WSGI 程序，把响应逐块交给事件循环发送"""
+        def send_message(message):
+            # 等待服务器接收这一块，客户端读得慢时服务器的缓冲区满了才会阻塞，起到限流作用
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+            return lambda data: send_chunk(data)
+
+        def send_chunk(data):
+            if not response.get('sent'):
+                send_message({'type': 'http.response.start', 'status': response['status'],
+                              'headers': response['headers']})
+                response['sent'] = True
+            if data:
+                send_message({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+        iterable = self.wsgi_app(build_environ(scope, body), start_response)
+        try:
+            for chunk in iterable:  # 流式响应（stream_template、导出）每产生一块就发送一块
+                send_chunk(chunk)
+            send_chunk(b'')
+            send_message({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+
+async def read_body(receive):
+    """读取完整的请求体，客户端中途断开时返回 None"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+def build_environ(scope, body):
+    """按 PEP 3333 从 ASGI scope 构造 WSGI environ"""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),  # WSGI 要求用 latin-1 表示原始字节
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':  # 已按实际读到的请求体设置
+            continue
+        key = 'HTTP_' + name
+        if key in environ:  # 同名请求头合并，Cookie 用分号分隔
+            value = environ[key] + ('; ' if name == 'COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+
+def __getattr__(name):
+    # uvicorn 导入 watchlist.asgi:application 时才按环境变量中的配置创建 app，
+    # 测试等只需要 AsgiAdapter 的地方导入本模块不会多创建一个 app
+    if name == 'application':
+        global application
+        application = AsgiAdapter(create_app())
+        return application
+    raise AttributeError("module 'watchlist.asgi' has no attribute %r" % name)
@@ -0,0 +1,144 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import threading
+
+from flask import Blueprint, current_app, request, send_from_directory, url_for as flask_url_for
+
+# 静态资源构建：把 static 目录下的文件按内容散列改名复制到 WATCHLIST_ASSET_DIR，
+# 文本类文件额外生成 .gz 和 .br 预压缩版本，并写出 manifest.json（原文件名 -> 带散列的文件名）
+# 模板中的 url_for('static', ...) 在 manifest 存在时输出 /assets/ 下带散列的地址，
+# 文件内容变了地址就会变，所以可以让浏览器永久缓存，不再每次访问页面都重新验证
+
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.xml', '.ico'}  # gif、png、jpg 等本身已压缩
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+bp = Blueprint('assets', __name__)
+
+
+def fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def precompress(path):
+    """生成 .gz 和 .br（需要安装 brotli）文件，压缩后没有变小的不保留"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    variants = [('.gz', lambda: gzip.compress(data, 9, mtime=0))]  # mtime=0 让相同内容的构建结果完全一致
+    try:
+        import brotli  # 可选依赖，没有安装时只生成 .gz
+    except ImportError:
+        pass
+    else:
+        variants.append(('.br', lambda: brotli.compress(data, quality=11)))
+    created = []
+    for suffix, compress in variants:
+        compressed = compress()
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+            created.append(suffix)
+    return created
+
+
+def build_assets(source, output):
+    """构建所有静态资源，返回新的 manifest；旧的带散列文件保留，正在加载旧页面的浏览器仍能取到"""
+    output = os.path.abspath(output)
+    manifest = {}
+    for directory, dirnames, filenames in os.walk(source):
+        dirnames[:] = [d for d in dirnames if os.path.abspath(os.path.join(directory, d)) != output]
+        for filename in sorted(filenames):
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, source).replace(os.sep, '/')
+            stem, ext = os.path.splitext(name)
+            hashed = '%s.%s%s' % (stem, fingerprint(path), ext)
+            target = os.path.join(output, hashed)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(path, target)
+                if ext.lower() in COMPRESSIBLE:
+                    precompress(target)
+            manifest[name] = hashed
+    tmp = os.path.join(output, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, os.path.join(output, MANIFEST))  # 原子替换，运行中的 worker 不会读到写了一半的文件
+    return manifest
+
+
+class Manifest(object):
+    """按需读取 manifest.json，文件修改后自动重新读取"""
+
+    def __init__(self):
+        self._entries = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        path = os.path.join(current_app.config['WATCHLIST_ASSET_DIR'], MANIFEST)
+        try:
+            mtime = (path, os.stat(path).st_mtime_ns)  # 同一进程中的多个 app 可能使用不同的构建目录
+        except OSError:  # 还没有构建过，使用普通的静态文件地址
+            return None
+        if mtime != self._mtime:
+            with self._lock:
+                with open(path) as f:
+                    self._entries = json.load(f)
+                self._mtime = mtime
+        return self._entries.get(filename)
+
+    def version(self):
+        """manifest.json 的修改时间，没有构建过时为 None；重新构建后缓存的页面片段随之失效"""
+        try:
+            return os.stat(os.path.join(current_app.config['WATCHLIST_ASSET_DIR'], MANIFEST)).st_mtime_ns
+        except OSError:
+            return None
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._mtime = None
+
+
+manifest = Manifest()
+
+
+def url_for(endpoint, **values):
+    """替换模板中的 url_for：静态文件有构建结果时指向带散列的地址"""
+    if endpoint == 'static' and current_app.config['WATCHLIST_ASSETS']:
+        hashed = manifest.get(values.get('filename', '').lstrip('/'))
+        if hashed is not None:
+            values['filename'] = hashed
+            return flask_url_for('assets.asset', **values)
+    return flask_url_for(endpoint, **values)
+
+
+@bp.record_once
+def install_url_for(state):
+    state.app.jinja_env.globals['url_for'] = url_for
+
+
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    directory = current_app.config['WATCHLIST_ASSET_DIR']
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    for name, suffix in (('br', '.br'), ('gzip', '.gz')):  # 优先使用压缩率更高的 brotli
+        if request.accept_encodings[name] and os.path.isfile(os.path.join(directory, filename + suffix)):
+            encoding = name
+            filename += suffix
+            break
+    response = send_from_directory(directory, filename, mimetype=mimetype)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,195 @@
+import json
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, current_app, make_response, request, session
+from flask_login import current_user
+from sqlalchemy.orm import make_transient_to_detached
+
+from watchlist import db
+
+
+# 进程内缓存后端：有容量上限的 LRU，超出时淘汰最久未使用的键
+class LocalBackend(object):
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()  # 多线程的 WSGI 服务器下会并发读写
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value, ttl=None):  # 容量有上限，不需要过期时间
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# 共享缓存后端：多个 worker 进程连同一个 Redis，失效操作对所有进程立即可见
+class RedisBackend(object):
+
+    def __init__(self, url, prefix='watchlist:'):
+        try:
+            import redis  # 可选依赖，只有配置了 Redis 地址时才需要安装
+        except ImportError:
+            raise RuntimeError('RedisBackend requires the "redis" package: pip install redis')
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self._client.set(self.prefix + key, json.dumps(value), ex=ttl)  # ttl 为 None 时不过期
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self._client.scan_iter(self.prefix + '*'))
+        if keys:
+            self._client.delete(*keys)
+
+
+def make_backend(maxsize):
+    """配置了 WATCHLIST_CACHE_REDIS_URL 时使用共享的 Redis 后端，否则使用进程内 LRU"""
+    url = current_app.config['WATCHLIST_CACHE_REDIS_URL']
+    if url:
+        return RedisBackend(url)
+    return LocalBackend(maxsize)
+
+
+# 缓存 User 记录，避免 inject_user 和 load_user 每次请求都查询数据库
+# 缓存里只存字段值，取出时用 merge(load=False) 放回当前 session，不会触发 SELECT，
+# 而且对象仍受 session 管理，settings() 里修改 current_user 后 commit 照常生效
+# 失效只对同一个缓存后端可见，所以默认只在配置了共享的 Redis 时开启，进程内缓存下其他 worker 会一直显示旧名字
+class UserCache(object):
+
+    columns = ('id', 'name', 'username')  # 不缓存 password_hash，用到时由 session 按需从数据库读取
+
+    def __init__(self):
+        self._backend = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = make_backend(maxsize=64)
+        return self._backend
+
+    def first(self):
+        """缓存版的 User.query.first()"""
+        from watchlist.models import User
+        return self._get('user:first', lambda: User.query.order_by(User.id).first())
+
+    def get(self, user_id):
+        """缓存版的 User.query.get(user_id)"""
+        from watchlist.models import User
+        return self._get('user:id:%d' % user_id, lambda: db.session.get(User, user_id))
+
+    def invalidate(self, user=None):
+        """用户信息修改后调用，删除相关的缓存项"""
+        keys = ['user:first']
+        if user is not None and user.id is not None:
+            keys.append('user:id:%d' % user.id)
+        self.backend.delete(*keys)
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = self.misses = 0
+
+    def _get(self, key, load):
+        if not current_app.config['WATCHLIST_USER_CACHE']:
+            return load()
+        data = self.backend.get(key)
+        if data is not None:
+            self.hits += 1
+            return self._attach(data)
+        self.misses += 1
+        user = load()
+        if user is not None:
+            self.backend.set(key, dict((c, getattr(user, c)) for c in self.columns))
+        return user
+
+    def _attach(self, data):
+        from watchlist.models import User
+        user = User(**data)
+        make_transient_to_detached(user)  # 标记为已持久化的分离对象，merge 时才能跳过查询
+        return db.session.merge(user, load=False)
+
+
+user_cache = UserCache()
+
+
+# 整页缓存：未登录访客看到的页面只在电影或用户名变化时才会改变，缓存渲染好的 HTML 直接返回
+# 缓存键包含清单主人、清单版本号和部署版本：任何写操作（包括其他 worker 和 CLI 命令）都会在同一事务中更新版本号，
+# 旧版本的页面不会再被命中，随后被 LRU 淘汰；不需要在写操作之后通知每个 worker。
+# initdb --drop 重建数据库后版本号从头开始，键中还包含数据库的 generation，其他 worker 缓存的旧页面不会被再次命中
+class PageCache(object):
+
+    def __init__(self):
+        self._backend = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = make_backend(maxsize=current_app.config['WATCHLIST_PAGE_CACHE_SIZE'])
+        return self._backend
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = self.misses = 0
+
+    def key(self):
+        from watchlist import current_owner_id
+        from watchlist.models import current_revision
+        from watchlist.templating import build_token
+        # 版本号与 conditional() 的 ETag 使用同一条记录（会话的 identity map 中已有），缓存的页面与 ETag 一致
+        revision = current_revision()
+        return 'page:%d:%d:%s:%s:%s' % (current_owner_id(), revision.revision, revision.generation, build_token(),
+                                        request.full_path)  # 路由和查询字符串都是键的一部分
+
+    def cached(self, view):
+        """视图装饰器：只缓存未登录用户、没有待显示 flash 消息的 GET 请求"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if (not current_app.config['WATCHLIST_PAGE_CACHE'] or request.method != 'GET'
+                    or current_user.is_authenticated or session.get('_flashes')):
+                return view(*args, **kwargs)
+            key = self.key()
+            data = self.backend.get(key)
+            if data is not None:
+                self.hits += 1
+                return Response(data['body'], mimetype=data['mimetype'])
+            self.misses += 1
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:  # 流式响应没有完整内容，不缓存
+                self.backend.set(key, {'body': response.get_data(as_text=True), 'mimetype': response.mimetype},
+                                 ttl=current_app.config['WATCHLIST_PAGE_CACHE_TTL'])
+            return response
+        return wrapper
+
+
+page_cache = PageCache()
@@ -0,0 +1,154 @@
+import math
+import threading
+import time
+
+from flask import Blueprint, abort, current_app, jsonify, request
+from sqlalchemy import event
+
+from watchlist import db, current_owner_id
+from watchlist.models import Change, ChangeHorizon
+from watchlist.pagination import SQLITE_INTEGER_MAX
+from watchlist.tenants import TenantSession, tenant_engine
+
+# 增量同步：/changes?since=<seq> 返回该清单在 seq 之后的变更（新增、修改和删除的墓碑），
+# 客户端保存最后一次拿到的 next，下次从这里继续，同步的流量只与变更的数量有关，与清单大小无关。
+# 带上 wait=<秒> 时是长轮询：没有新变更就等待，直到有写入或超时。本进程内的写入提交后立即唤醒等待的请求，
+# 其他进程（包括 CLI 命令）的写入在下一次轮询数据库时发现，间隔为 WATCHLIST_CHANGES_POLL 秒。
+# 等待中的请求占着 worker 线程，同时等待的请求超过 WATCHLIST_CHANGES_MAX_WAITERS 时新请求不等待，
+# 客户端照常用返回的 next 再次请求即可，不会让长轮询占满线程、挡住普通页面
+bp = Blueprint('changes', __name__)
+
+
+class ChangeNotifier(object):
+    """会话提交后唤醒等待中的长轮询请求"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._version = 0
+        self._waiters = 0
+
+    @property
+    def version(self):
+        return self._version
+
+    def notify(self):
+        with self._condition:
+            self._version += 1
+            self._condition.notify_all()
+
+    def wait(self, version, timeout):
+        """等待 version 之后的提交，超时返回 False"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._version != version, timeout)
+
+    def enter(self, limit):
+        """登记一个等待的请求，已有 limit 个时返回 False；返回 True 的需要在结束后调用 leave()"""
+        with self._condition:
+            if self._waiters >= limit:
+                return False
+            self._waiters += 1
+            return True
+
+    def leave(self):
+        with self._condition:
+            self._waiters -= 1
+
+    def reset(self):
+        """fork 之后在子进程中调用，继承来的锁可能正被父进程的其他线程持有，父进程中等待的请求也不在子进程中"""
+        self._condition = threading.Condition()
+        self._waiters = 0
+
+
+notifier = ChangeNotifier()
+
+
+@event.listens_for(TenantSession, 'after_commit')
+def notify_commit(session):
+    notifier.notify()
+
+
+def read_changes(engine, user_id, since, limit):
+    """读取 since 之后的变更，每次用新的连接，长轮询等待期间不占用连接，也不会停留在旧的读快照上"""
+    change = Change.__table__
+    with engine.connect() as conn:
+        horizon = conn.execute(db.select(ChangeHorizon.seq).where(ChangeHorizon.id == 1)).scalar() or 0
+        last = max(conn.execute(db.select(db.func.max(change.c.seq))).scalar() or 0, horizon)
+        rows = conn.execute(db.select(change).where(change.c.user_id == user_id, change.c.seq > since)
+                            .order_by(change.c.seq).limit(limit + 1)).all()
+    # since 早于被压缩掉的墓碑，或者比现有的最大序号还大（数据库被重建），增量已经接不上，需要全量同步
+    resync = since < horizon or since > last
+    return {
+        'changes': [change_to_dict(row) for row in rows[:limit]],
+        'next': last if resync else (rows[:limit][-1].seq if rows else since),
+        'more': len(rows) > limit,
+        'resync': resync,
+    }
+
+
+def change_to_dict(row):
+    data = {'seq': row.seq, 'kind': row.kind, 'op': row.op, 'id': row.object_id}
+    if row.op != 'delete':
+        if row.kind == 'movie':
+            data.update(title=row.title, year=row.year)
+        else:
+            data['name'] = row.title
+    return data
+
+
+@bp.route('/changes')
+def changes():
+    """返回 {"changes": [...], "next": seq, "more": bool, "resync": bool}
+
+    insert 和 update 都按 upsert 处理（压缩后同一条目只保留最后一条记录），delete 删除该条目；
+    more 为 true 时立即用 next 再请求一次；resync 为 true 时重新获取整个清单，再从 next 开始增量同步。
+    """
+    # 比任何序号都大的 since 限制在 SQLite INTEGER 范围内，同样得到 resync
+    since = min(max(request.args.get('since', 0, type=int), 0), SQLITE_INTEGER_MAX)
+    limit = min(max(request.args.get('limit', current_app.config['WATCHLIST_CHANGES_LIMIT'], type=int), 1),
+                current_app.config['WATCHLIST_CHANGES_LIMIT'])
+    wait = request.args.get('wait', 0, type=float)
+    if not math.isfinite(wait):  # nan 和任何数比较都是 False，下面的循环永远不会结束
+        abort(400)
+    wait = min(max(wait, 0), current_app.config['WATCHLIST_CHANGES_MAX_WAIT'])
+    user_id = current_owner_id()
+    engine = tenant_engine(user_id) if user_id else db.engine  # 还没有用户时读主数据库（没有任何变更）
+    db.session.close()  # 归还会话占用的连接，等待期间不保持读事务
+    waiting = wait > 0 and notifier.enter(current_app.config['WATCHLIST_CHANGES_MAX_WAITERS'])
+    deadline = time.monotonic() + (wait if waiting else 0)
+    try:
+        while True:
+            version = notifier.version  # 先记下版本再查询，查询之后的提交一定会唤醒下面的等待
+            feed = read_changes(engine, user_id, since, limit)
+            remaining = deadline - time.monotonic()
+            if feed['changes'] or feed['resync'] or remaining <= 0:
+                break
+            notifier.wait(version, min(remaining, current_app.config['WATCHLIST_CHANGES_POLL']))
+    finally:
+        if waiting:
+            notifier.leave()
+    response = jsonify(feed)
+    response.cache_control.no_store = True
+    return response
+
+
+def compact_changes(engine, cutoff):
+    """压缩变更记录：删除已被同一对象更新的记录取代的旧记录，再删除 cutoff 及之前的墓碑并提高 horizon
+
+    返回 (取代的记录数, 删除的墓碑数)
+    """
+    change = Change.__table__
+    newer = change.alias('newer')
+    with engine.begin() as conn:
+        superseded = conn.execute(change.delete().where(db.exists().where(
+            newer.c.kind == change.c.kind, newer.c.object_id == change.c.object_id,
+            newer.c.seq > change.c.seq))).rowcount
+        old_tombstones = db.and_(change.c.op == 'delete', change.c.created_at <= cutoff)
+        pruned = conn.execute(db.select(db.func.max(change.c.seq)).where(old_tombstones)).scalar()
+        tombstones = 0
+        if pruned is not None:
+            tombstones = conn.execute(change.delete().where(old_tombstones)).rowcount
+            horizon = ChangeHorizon.__table__
+            if conn.execute(horizon.update().where(horizon.c.id == 1)
+                            .values(seq=db.func.max(horizon.c.seq, pruned))).rowcount == 0:
+                conn.execute(horizon.insert().values(id=1, seq=pruned))
+    return superseded, tombstones
@@ -1,22 +1,55 @@
+import csv
+import io
+import json
+import os
+from datetime import timedelta
+from itertools import islice
+
 import click
+from flask import Blueprint, current_app
+from sqlalchemy import text
+
+from watchlist import db
+from watchlist.cache import page_cache, user_cache
+from watchlist.export import export_chunks, gzip_chunks
+from watchlist.models import User, Movie, validate_movie, bump_revision, record_changes, record_movie_changes, upgrade_revision_table, utcnow
+from watchlist.search import create_search_index, rebuild_search_index
+from watchlist.tenants import tenant_engine, tenant_engines, tenant_mode, tenant_scope, tenant_tables
 
-from watchlist import app, db
-from watchlist.models import User, Movie
+# cli_group=None：命令直接注册在 flask 下（flask initdb），而不是 flask commands initdb
+bp = Blueprint('commands', __name__, cli_group=None)
 
 
 # 注册为flask命令，这样可以在命令行中通过 flask initdb 来调用这个函数
-@app.cli.command()
+@bp.cli.command()
 # 定义了一个名为 --drop 的命令行选项，如果传入这个选项，则 drop 参数的值将为 True
 @click.option('--drop', is_flag=True, help='Create after drop.')
-def initdb(drop):
+@click.option('--tenant', help="Only initialize this user's database file (per-tenant mode).")
+def initdb(drop, tenant):
     """初始化数据库"""
+    if tenant:
+        # 按用户分库时，只初始化（或清空后重建）这个用户的数据库文件
+        if not tenant_mode():
+            raise click.UsageError('--tenant requires WATCHLIST_TENANT_DIR to be set.')
+        tenant_id = find_user(tenant).id
+        if drop:
+            tenant_engines.drop(tenant_id)
+            page_cache.clear()
+        db.metadata.create_all(tenant_engines.get(tenant_id), tables=tenant_tables())
+        click.echo('Initialized database for %s.' % tenant)
+        return
     if drop:
         db.drop_all()  # 如果使用此命令时加上了'--drop'，则drop为True，则清除数据库
+        user_cache.clear()
+        page_cache.clear()
+        if tenant_mode():  # 用户数据库文件以 id 命名，和 user 表一起删除（运行中的 worker 需要重启）
+            click.echo('Removed %d tenant databases.' % tenant_engines.purge())
     db.create_all()  # 创建表格结构，但不会往表格中输入数据，若目前已有表格和数据，此方法不会做任何改变
     click.echo('Initialized database.')  # 输出提示信息
 
-@app.cli.command()
-def forge():
+@bp.cli.command()
+@click.option('--tenant', help="Add the movies to this existing user's watchlist instead of creating a user.")
+def forge(tenant):
     """数据输入数据库"""
     db.create_all()
     # 定义虚拟数据，可用 faker 库的 Faker 类来生成虚拟数据，这里直接输入
@@ -35,19 +68,30 @@ def forge():
         {'title': 'Inception', 'year': 2010}
     ]
 
-    user = User(name=name)
-    db.session.add(user)
-    for m in movies:
-        # 逐个取出movies 列表中的字典，放入movie 变量中
-        movie = Movie(title=m['title'],year=m['year'])
-        # 把每个取出来的movie 添加到数据库
-        db.session.add(movie)
-    # user和movie一起commit
-    db.session.commit()
+    if tenant:
+        user = find_user(tenant)
+    else:
+        user = User(name=name)
+        db.session.add(user)
+        db.session.flush()  # 先写入用户拿到 id，按用户分库时据此选择电影写入的数据库
+    with tenant_scope(user.id):
+        forged = []
+        for m in movies:
+            # 逐个取出movies 列表中的字典，放入movie 变量中
+            movie = Movie(title=m['title'],year=m['year'],owner=user)  # 电影属于这个用户
+            # 把每个取出来的movie 添加到数据库
+            db.session.add(movie)
+            forged.append(movie)
+        db.session.flush()
+        record_changes('insert', forged if tenant else [user] + forged)  # 新建的用户也记一条
+        bump_revision()
+        # user和movie一起commit
+        db.session.commit()
+    user_cache.invalidate(user)
     # 打印完成信息
     click.echo('Mission Accomplished')
 
-@app.cli.command()
+@bp.cli.command()
 @click.option('--username', prompt=True, help='The username used to login.')  # 接收输入的用户名
 # 接收输入的密码，hide_input=True让密码隐藏输入
 @click.option(
@@ -61,11 +105,314 @@ def admin(username, password):
         click.echo('Updating user...')
         user.username = username
         user.set_password(password)
+        op = 'update'
     else:
         click.echo('Creating user...')
         # 数据库中为空时，要先实例化，才能add
         user = User(username=username,name='Admin')
         user.set_password(password)
         db.session.add(user)
+        op = 'insert'
+    db.session.flush()
+    with tenant_scope(user.id):
+        record_changes(op, [user])
+        bump_revision()
+        db.session.commit()
+    user_cache.invalidate(user)  # 账户信息已变化，清除缓存
+    click.echo('Done.')
+
+@bp.cli.command('add-user')
+@click.option('--username', prompt=True, help='The username used to login.')
+@click.option('--name', prompt=True, help='The name shown in the page title.')
+@click.option(
+    '--password', prompt=True, hide_input=True,
+    confirmation_prompt=True, help='The password used to login.')
+def add_user(username, name, password):
+    """添加一个拥有独立观影清单的用户"""
+    db.create_all()
+    if User.query.filter_by(username=username).first() is not None:
+        raise click.UsageError('User %s already exists.' % username)
+    user = User(username=username, name=name)
+    user.set_password(password)
+    db.session.add(user)
     db.session.commit()
-    click.echo('Done.')
\ No newline at end of file
+    click.echo('Created user %s.' % username)
+
+
+def find_user(username):
+    """按用户名查找用户，没有指定时使用第一个用户"""
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.UsageError('No user named %s.' % username)
+    else:
+        user = User.query.order_by(User.id).first()
+        if user is None:
+            raise click.UsageError('No users yet; create one with flask admin.')
+    return user
+
+# 旧版数据库的 movie.year 是 VARCHAR(4)，SQLite 无法直接修改列类型，只能建新表、复制数据再替换
+# 复制按批进行，每批一个短事务，期间其他请求仍能正常读写；迁移过程中的写入由触发器同步到新表
+# 单用户版本的 movie 表没有 user_id 列，迁移时添加该列，并把没有所属用户的电影分配给 --username 指定的用户
+@bp.cli.command('migrate-schema')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows copied per transaction.')
+@click.option('--username', help='Owner of movies without one; defaults to the first user.')
+def migrate_schema(batch_size, username):
+    """把 movie 表迁移到整数年份、按用户区分的清单和新索引"""
+    db.create_all()
+    with db.engine.begin() as conn:
+        upgrade_revision_table(conn)
+    with db.engine.connect() as conn:
+        columns = dict((row[1], row[2].upper()) for row in conn.execute(text('PRAGMA table_info(movie)')))
+    if 'user_id' not in columns:
+        # 添加允许为 NULL 的列只修改表定义，不会重写已有的行
+        with db.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE movie ADD COLUMN user_id INTEGER REFERENCES user (id)'))
+    if columns.get('year') != 'INTEGER':
+        _rebuild_movie_table(batch_size)
+    else:
+        click.echo('Movie table is up to date.')
+    if User.query.first() is not None:
+        _assign_owner(find_user(username), batch_size)
+    # 建索引只锁住写操作，读请求不受影响；已存在的索引会跳过
+    with db.engine.begin() as conn:
+        existing = set(row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")))
+        for index in list(Movie.__table__.indexes) + list(User.__table__.indexes):
+            if index.name not in existing:
+                index.create(conn)
+    click.echo('Done.')
+
+
+def _assign_owner(user, batch_size):
+    """按批把 user_id 为 NULL 的电影分配给 user，每批一个短事务"""
+    assigned = 0
+    movie = Movie.__table__
+    while True:
+        with db.engine.begin() as conn:
+            ids = conn.execute(db.select(movie.c.id).where(movie.c.user_id.is_(None)).limit(batch_size)).scalars().all()
+            if ids:
+                conn.execute(movie.update().where(movie.c.id.in_(ids)).values(user_id=user.id))
+                # 这些电影之前不属于任何清单，对同步客户端来说是新增的
+                record_movie_changes('insert', movie.c.id.in_(ids), conn)
+                bump_revision(conn)
+        if not ids:
+            break
+        assigned += len(ids)
+    if assigned:
+        click.echo('Assigned %d movies to %s.' % (assigned, user.username or user.name))
+
+
+def _rebuild_movie_table(batch_size):
+    with db.engine.begin() as conn:
+        conn.execute(text('DROP TABLE IF EXISTS movie_new'))
+        conn.execute(text('CREATE TABLE movie_new (id INTEGER NOT NULL PRIMARY KEY, '
+                          'title VARCHAR(60), year INTEGER, user_id INTEGER REFERENCES user (id))'))
+        # 复制期间对旧表的增删改同步到新表，保证替换时两边数据一致
+        conn.execute(text('CREATE TRIGGER movie_migrate_insert AFTER INSERT ON movie BEGIN '
+                          'INSERT OR REPLACE INTO movie_new (id, title, year, user_id) '
+                          'VALUES (new.id, new.title, CAST(new.year AS INTEGER), new.user_id); END'))
+        conn.execute(text('CREATE TRIGGER movie_migrate_update AFTER UPDATE ON movie BEGIN '
+                          'INSERT OR REPLACE INTO movie_new (id, title, year, user_id) '
+                          'VALUES (new.id, new.title, CAST(new.year AS INTEGER), new.user_id); END'))
+        conn.execute(text('CREATE TRIGGER movie_migrate_delete AFTER DELETE ON movie BEGIN '
+                          'DELETE FROM movie_new WHERE id = old.id; END'))
+
+    last_id, copied = 0, 0
+    while True:
+        with db.engine.begin() as conn:
+            # 按主键区间取一批；OR IGNORE 保留触发器已经写入的较新数据
+            rows = conn.execute(text('SELECT id FROM movie WHERE id > :last ORDER BY id LIMIT :n'),
+                                {'last': last_id, 'n': batch_size}).fetchall()
+            if not rows:
+                break
+            conn.execute(text('INSERT OR IGNORE INTO movie_new (id, title, year, user_id) '
+                              'SELECT id, title, CAST(year AS INTEGER), user_id FROM movie '
+                              'WHERE id > :last AND id <= :upper'),
+                         {'last': last_id, 'upper': rows[-1][0]})
+        last_id = rows[-1][0]
+        copied += len(rows)
+        click.echo('Copied %d rows...' % copied)
+
+    # 最后用一个很短的事务替换表，这是唯一需要独占数据库的步骤
+    with db.engine.begin() as conn:
+        for name in ('insert', 'update', 'delete'):
+            conn.execute(text('DROP TRIGGER movie_migrate_%s' % name))
+        conn.execute(text('DROP TABLE movie'))
+        conn.execute(text('ALTER TABLE movie_new RENAME TO movie'))
+        # 旧表上的全文索引触发器随旧表一起删除了，在新表上重新创建
+        create_search_index(conn)
+    with db.engine.begin() as conn:
+        rebuild_search_index(conn)
+    click.echo('Migrated %d movies.' % copied)
+
+
+@bp.cli.command('rebuild-search')
+def rebuild_search():
+    """创建并重建电影标题的全文索引"""
+    db.create_all()
+    with db.engine.begin() as conn:
+        create_search_index(conn)
+        rebuild_search_index(conn)
+    click.echo('Search index rebuilt.')
+
+
+
+# 从 CSV（表头为 title,year）或 JSONL（每行一个 {"title": ..., "year": ...}）逐行读取电影数据
+# 每 chunk_size 行用一条 executemany 的 INSERT 写入，一个分块一个事务，内存占用与文件大小无关
+@bp.cli.command('import')
+@click.argument('source', type=click.File('rb'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Input format; guessed from the file extension if omitted (stdin defaults to csv).')
+@click.option('--chunk-size', default=10000, show_default=True, help='Rows inserted per transaction.')
+@click.option('--rejects', type=click.File('w'), help='Write rejected rows to this file as JSONL.')
+@click.option('--username', help="Import into this user's watchlist; defaults to the first user.")
+def import_movies(source, fmt, chunk_size, rejects, username):
+    """从 CSV 或 JSONL 文件（或标准输入）批量导入电影"""
+    db.create_all()
+    user_id = find_user(username).id
+    engine = tenant_engine(user_id)  # 按用户分库时写入该用户的数据库
+    if fmt is None:
+        fmt = 'jsonl' if getattr(source, 'name', '').endswith(('.jsonl', '.json')) else 'csv'
+    stream = io.TextIOWrapper(source, encoding='utf-8-sig', newline='')  # utf-8-sig 兼容带 BOM 的 CSV
+    rows = ImportRows(stream, fmt, rejects, user_id)
+    records = iter(rows)
+
+    insert = Movie.__table__.insert()
+    imported = 0
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        with engine.begin() as conn:
+            last_id = conn.execute(db.select(db.func.max(Movie.id))).scalar() or 0
+            conn.execute(insert, chunk)  # 传入字典列表即为 executemany
+            # 新插入的行 id 都大于插入前的最大 id，同一个事务中一起写入变更记录
+            record_movie_changes('insert', db.and_(Movie.id > last_id, Movie.user_id == user_id), conn)
+            bump_revision(conn)
+        imported += len(chunk)
+        click.echo('Imported %d rows...' % imported, err=True)
+    click.echo('Imported %d movies, rejected %d rows.' % (imported, rows.rejected))
+
+
+class ImportRows(object):
+    """逐行解析并校验导入数据的迭代器，只产出合格的行，不合格的行计数并写入 rejects 文件"""
+
+    def __init__(self, stream, fmt, rejects=None, user_id=None):
+        self.stream = stream
+        self.fmt = fmt
+        self.rejects = rejects
+        self.user_id = user_id
+        self.rejected = 0
+
+    def __iter__(self):
+        for line_no, record in self._records():
+            title = str(record.get('title') or '').strip() if isinstance(record, dict) else ''
+            year = str(record.get('year') or '').strip() if isinstance(record, dict) else ''
+            if validate_movie(title, year):  # 与 index() 使用相同的校验规则
+                yield {'title': title, 'year': int(year), 'user_id': self.user_id}
+            else:
+                self._reject(line_no, record)
+
+    def _records(self):
+        if self.fmt == 'csv':
+            reader = csv.DictReader(self.stream)
+            for record in reader:
+                yield reader.line_num, record
+            return
+        for line_no, line in enumerate(self.stream, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_no, json.loads(line)
+            except ValueError:
+                yield line_no, line.rstrip('\n')
+
+    def _reject(self, line_no, record):
+        self.rejected += 1
+        if self.rejected <= 10:  # 只在终端显示前几条，全部的不合格行写入 rejects 文件
+            click.echo('Rejected line %d: %r' % (line_no, record), err=True)
+        if self.rejects is not None:
+            self.rejects.write(json.dumps({'line': line_no, 'row': record}, ensure_ascii=False) + '\n')
+
+
+@bp.cli.command('export')
+@click.argument('output', type=click.File('wb'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv', show_default=True)
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output with gzip.')
+@click.option('--username', help="Only export this user's watchlist (required in per-tenant mode).")
+def export_movies(output, fmt, compress, username):
+    """把所有电影导出为 CSV 或 JSONL（默认输出到标准输出）"""
+    if tenant_mode() and not username:
+        # 按用户分库时每个用户的电影在各自的文件中，主数据库的 movie 表是空的
+        raise click.UsageError('--username is required when WATCHLIST_TENANT_DIR is set.')
+    user_id = find_user(username).id if username else None
+    chunks = export_chunks(fmt, user_id)
+    if compress:
+        chunks = gzip_chunks(chunks)
+    with tenant_scope(user_id):
+        for chunk in chunks:
+            output.write(chunk)
+
+
+@bp.cli.command('profile-report')
+@click.option('--top', default=20, show_default=True, help='Functions listed per route.')
+@click.option('--dir', 'root', help='Profile directory; defaults to WATCHLIST_PROFILE_DIR.')
+def profile_report(top, root):
+    """汇总慢请求分析文件，按 endpoint 列出最耗时的函数"""
+    from watchlist.profiling import report
+    root = root or current_app.config['WATCHLIST_PROFILE_DIR']
+    if not root or not os.path.isdir(root):
+        raise click.UsageError('No profile directory; set WATCHLIST_PROFILE_DIR or pass --dir.')
+    for endpoint, result in report(root, top).items():
+        click.echo('== %s' % endpoint)
+        if result['timed']:
+            click.echo('-- cProfile, %d requests (own s / cumulative s)' % result['profiles'])
+            for name, own, cumulative in result['timed']:
+                click.echo('%10.4f %10.4f  %s' % (own, cumulative, name))
+        if result['sampled']:
+            click.echo('-- stack samples, %d total (own / inclusive)' % result['samples'])
+            for name, own, inclusive in result['sampled']:
+                click.echo('%10d %10d  %s' % (own, inclusive, name))
+
+
+@bp.cli.command('build-assets')
+@click.option('--output', help='Output directory; defaults to WATCHLIST_ASSET_DIR.')
+def build_static_assets(output):
+    """给静态文件加上内容散列、预压缩文本文件并写出 manifest"""
+    from watchlist.assets import build_assets
+    output = output or current_app.config['WATCHLIST_ASSET_DIR']
+    manifest = build_assets(current_app.static_folder, output)
+    for name, hashed in sorted(manifest.items()):
+        click.echo('%s -> %s' % (name, hashed))
+    click.echo('Built %d assets into %s.' % (len(manifest), output))
+
+
+@bp.cli.command('compile-templates')
+@click.option('--clear', is_flag=True, help='Remove the cached bytecode first.')
+def compile_all_templates(clear):
+    """把所有模板编译到字节码缓存中，部署时执行，worker 启动后不必再编译"""
+    from watchlist.templating import compile_templates
+    cache = current_app.jinja_env.bytecode_cache
+    if cache is None:
+        click.echo('Template bytecode cache is disabled (WATCHLIST_TEMPLATE_CACHE_DIR).')
+        return
+    if clear:
+        cache.clear()
+    names = compile_templates()
+    click.echo('Compiled %d templates into %s.' % (len(names), current_app.config['WATCHLIST_TEMPLATE_CACHE_DIR']))
+
+
+@bp.cli.command('compact-changes')
+@click.option('--days', default=30, show_default=True, help='Keep tombstones newer than this many days.')
+def compact_change_log(days):
+    """压缩 /changes 使用的变更记录：去掉已被新记录取代的旧记录和过期的墓碑"""
+    from watchlist.changes import compact_changes
+    db.create_all()
+    cutoff = utcnow() - timedelta(days=days)
+    engines = [tenant_engine(user.id) for user in User.query.order_by(User.id)] if tenant_mode() else [db.engine]
+    superseded = tombstones = 0
+    for engine in engines:
+        counts = compact_changes(engine, cutoff)
+        superseded += counts[0]
+        tombstones += counts[1]
+    click.echo('Removed %d superseded changes and %d tombstones.' % (superseded, tombstones))
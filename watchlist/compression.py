@@ -0,0 +1,98 @@
+import zlib
+
+from flask import Blueprint, current_app, request
+
+try:
+    import brotli  # 可选依赖，没有安装时只使用 gzip
+except ImportError:
+    brotli = None
+
+# 响应压缩：主页每一行都重复同样的 Edit/Delete 表单和豆瓣链接，HTML 压缩后通常只有原来的十分之一左右。
+# 浏览器在 Accept-Encoding 中声明支持时，文本类响应（HTML、JSON、CSV 等）按 br 或 gzip 压缩；
+# 小于 WATCHLIST_COMPRESS_MIN_SIZE 的响应压缩后省不了多少，不压缩。流式响应（stream_template、导出）
+# 逐块压缩：第一块立即刷新，浏览器仍然能先收到页头，之后每攒够 FLUSH_SIZE 字节刷新一次；
+# 已经压缩过的内容（图片、.gz 文件、/assets/ 的预压缩文件）原样返回。关闭 WATCHLIST_COMPRESS 时不注册
+bp = Blueprint('compression', __name__)
+
+COMPRESSIBLE = {
+    'application/javascript', 'application/json', 'application/x-ndjson', 'application/xml', 'image/svg+xml',
+}
+FLUSH_SIZE = 16 * 1024  # 流式压缩时每累计这么多原始字节刷新一次
+
+
+def compressible(response):
+    mimetype = response.mimetype or ''
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE
+
+
+def choose_encoding():
+    """按浏览器支持的编码选择，优先使用压缩率更高的 brotli"""
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compressor(encoding):
+    """返回 (compress, flush, finish)：compress 压缩一块数据，flush 输出已压缩的部分，finish 结束压缩流"""
+    if encoding == 'br':
+        c = brotli.Compressor(quality=current_app.config['WATCHLIST_COMPRESS_BROTLI_QUALITY'])
+        return c.process, c.flush, c.finish
+    c = zlib.compressobj(current_app.config['WATCHLIST_COMPRESS_LEVEL'], zlib.DEFLATED, 31)  # wbits=31 表示输出 gzip 头和校验
+    return c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush
+
+
+def compress(data, encoding):
+    compress_chunk, _, finish = compressor(encoding)
+    return compress_chunk(data) + finish()
+
+
+def compress_chunks(chunks, encoding, flush_size=FLUSH_SIZE):
+    """逐块压缩，不等到内容全部生成；stream_template 产生的块很碎，每块都单独压缩、刷新会让压缩率明显下降，
+    所以第一块（页头）立即压缩并刷新，让浏览器尽早开始加载样式表，之后先攒够 flush_size 字节再刷新输出"""
+    compress_chunk, flush, finish = compressor(encoding)
+    buffer, pending = [], 0
+    first = True
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            buffer.append(chunk)
+            pending += len(chunk)
+            if pending >= flush_size or (first and pending):
+                first = False
+                data = compress_chunk(b''.join(buffer)) + flush()
+                buffer, pending = [], 0
+                if data:
+                    yield data
+        yield compress_chunk(b''.join(buffer)) + finish()
+    finally:
+        if hasattr(chunks, 'close'):  # 客户端提前断开时也要关闭原来的生成器（stream_with_context 在其中弹出请求上下文）
+            chunks.close()
+
+
+@bp.after_app_request
+def compress_response(response):
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough  # send_file 发送的文件，静态资源由 flask build-assets 预压缩
+            or 'Content-Encoding' in response.headers or not compressible(response)
+            or 'no-transform' in response.headers.get('Cache-Control', '')):
+        return response
+    if not response.is_streamed and (response.content_length or 0) < current_app.config['WATCHLIST_COMPRESS_MIN_SIZE']:
+        return response
+    response.vary.add('Accept-Encoding')  # 缓存服务器要按 Accept-Encoding 分别缓存
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    # 压缩后字节不同，强 ETag 改为弱 ETag；If-None-Match 按弱比较，浏览器带回的 W/"..." 仍能得到 304
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
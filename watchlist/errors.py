@@ -1,16 +1,22 @@
-from flask import render_template
+from flask import Blueprint, render_template
 
-from watchlist import app
+# 网页的错误页面，对整个 app 生效；API 蓝本注册了自己的 JSON 错误处理函数，会优先使用
+bp = Blueprint('errors', __name__)
 
 # 注册一个错误处理函数，当404错误发生时会触发
-@app.errorhandler(404)  # 传入要处理的错误代码
+@bp.app_errorhandler(404)  # 传入要处理的错误代码
 def page_not_found(e):  # 接受异常对象作为参数
     return render_template('errors/404.html'), 404  # 返回模板和状态码，正常情况下默认隐藏返回200，表示访问成功
 
-@app.errorhandler(400)
+@bp.app_errorhandler(400)
 def bad_request(e):
     return render_template('errors/400.html'), 400
 
-@app.errorhandler(500)
+@bp.app_errorhandler(429)
+def too_many_requests(e):
+    headers = {'Retry-After': str(e.retry_after)} if getattr(e, 'retry_after', None) else {}
+    return render_template('errors/429.html'), 429, headers
+
+@bp.app_errorhandler(500)
 def internal_server_error(e):
     return render_template('errors/500.html'), 500
\ No newline at end of file
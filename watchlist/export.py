@@ -0,0 +1,42 @@
+import csv
+import io
+import json
+import zlib
+
+from flask import current_app
+
+from watchlist import db
+from watchlist.models import Movie, movie_row
+
+
+def export_chunks(fmt, user_id=None):
+    """逐批生成导出内容（bytes），每批对应数据库游标的一次 yield_per 读取；user_id 为 None 时导出所有用户的电影"""
+    batch_size = current_app.config['WATCHLIST_STREAM_BATCH']
+    # 只查询需要的列，execution_options(yield_per=...) 让结果按批从游标中取出，而不是一次读完
+    statement = db.select(movie_row).order_by(Movie.id)
+    if user_id is not None:
+        statement = statement.where(Movie.user_id == user_id)
+    result = db.session.execute(statement.execution_options(yield_per=batch_size)).scalars()
+    if fmt == 'csv':
+        yield b'id,title,year\r\n'
+    for rows in result.partitions():
+        buffer = io.StringIO()
+        if fmt == 'csv':
+            writer = csv.writer(buffer)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps({'id': row.id, 'title': row.title, 'year': row.year},
+                                        ensure_ascii=False))
+                buffer.write('\n')
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_chunks(chunks, level=6):
+    """把字节流逐块压缩为 gzip 格式，不需要先拿到完整内容"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 表示输出 gzip 头和校验
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
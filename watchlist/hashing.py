@@ -0,0 +1,73 @@
+import threading
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingBusy(Exception):
+    """等待计算的密码散列任务已达上限"""
+
+
+# 密码散列（scrypt/pbkdf2）故意设计得很耗 CPU，放到有上限的线程池中计算
+# hashlib 计算时会释放 GIL，所以线程池就能利用多核；排队的任务数超过上限时立即抛出 HashingBusy，
+# 让登录请求快速返回 429，而不是让大量请求线程都卡在散列计算上
+class HashPool(object):
+
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+        self._method = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with self._lock:
+            if self._executor is None:  # 第一次使用时才创建，每个 worker 进程各自创建自己的线程池
+                workers = current_app.config['WATCHLIST_HASH_WORKERS']
+                self._slots = threading.BoundedSemaphore(workers + current_app.config['WATCHLIST_HASH_QUEUE'])
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+
+    def run(self, func, *args):
+        if self._executor is None:
+            self._start()
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future.result()
+
+    def reset(self):
+        """fork 之后在子进程中调用：父进程的线程不会复制到子进程，下次使用时重新创建线程池"""
+        self._executor = self._slots = None
+        self._lock = threading.Lock()
+
+    def shutdown(self):
+        """关闭线程池，下次使用时按当前配置重新创建"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+            self._executor = self._slots = self._method = None
+
+    @property
+    def method(self):
+        """配置的散列方法的完整写法，例如 'scrypt' 会补全为 'scrypt:32768:8:1'"""
+        if self._method is None:
+            self._method = generate_password_hash('', method=current_app.config['WATCHLIST_HASH_METHOD']).split('$', 1)[0]
+        return self._method
+
+    def generate(self, password):
+        return self.run(generate_password_hash, password, current_app.config['WATCHLIST_HASH_METHOD'])
+
+    def check(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """散列值使用的方法或参数与当前配置不同时需要重新计算"""
+        return password_hash.split('$', 1)[0] != self.method
+
+
+hash_pool = HashPool()
@@ -0,0 +1,164 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from flask import Blueprint, Response, before_render_template, g, has_app_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('watchlist.instrumentation')
+
+
+# 每个请求的耗时统计：SQL 查询数和总耗时、模板渲染耗时、视图本身的耗时
+# 通过 WATCHLIST_INSTRUMENTATION 开启；关闭时 create_app() 不导入本模块，不注册任何钩子和事件监听
+bp = Blueprint('instrumentation', __name__)
+
+
+class RequestTimer(object):
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self._query_started = None
+        self._render_started = None
+
+    def result(self):
+        total = time.perf_counter() - self.started
+        return {
+            'queries': self.queries,
+            'db': self.db_time,
+            'render': self.render_time,
+            'handler': max(total - self.db_time - self.render_time, 0.0),
+            'total': total,
+        }
+
+
+class Metrics(object):
+    """按 endpoint 汇总的计数，以 Prometheus 文本格式输出"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = defaultdict(int)
+        self.sums = defaultdict(float)
+
+    def record(self, endpoint, timing):
+        with self._lock:
+            self.requests[endpoint] += 1
+            for key in ('queries', 'db', 'render', 'handler', 'total'):
+                self.sums[endpoint, key] += timing[key]
+
+    def render(self):
+        from watchlist.cache import page_cache, user_cache
+        series = [
+            ('watchlist_requests_total', 'counter', 'Requests handled.', None),
+            ('watchlist_db_queries_total', 'counter', 'SQL statements executed.', 'queries'),
+            ('watchlist_db_seconds_total', 'counter', 'Time spent executing SQL.', 'db'),
+            ('watchlist_render_seconds_total', 'counter', 'Time spent rendering templates.', 'render'),
+            ('watchlist_handler_seconds_total', 'counter', 'Time spent in view code outside SQL and templates.', 'handler'),
+            ('watchlist_request_seconds_total', 'counter', 'Total request time.', 'total'),
+        ]
+        lines = []
+        with self._lock:
+            for name, kind, help_text, key in series:
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for endpoint in sorted(self.requests):
+                    value = self.requests[endpoint] if key is None else self.sums[endpoint, key]
+                    lines.append('%s{endpoint="%s"} %s' % (name, endpoint, _number(value)))
+        for name, cache in (('user', user_cache), ('page', page_cache)):
+            lines.append('# TYPE watchlist_%s_cache_hits_total counter' % name)
+            lines.append('watchlist_%s_cache_hits_total %d' % (name, cache.hits))
+            lines.append('# TYPE watchlist_%s_cache_misses_total counter' % name)
+            lines.append('watchlist_%s_cache_misses_total %d' % (name, cache.misses))
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    return str(value) if isinstance(value, int) else '%.6f' % value
+
+
+metrics = Metrics()
+_installed = False
+_install_lock = threading.Lock()
+
+
+def _timer():
+    return g.get('_request_timer') if has_app_context() else None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timer = _timer()
+    if timer is not None:
+        timer._query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timer = _timer()
+    if timer is not None and timer._query_started is not None:
+        timer.queries += 1
+        timer.db_time += time.perf_counter() - timer._query_started
+        timer._query_started = None
+
+
+def before_render(sender, template, context, **extra):
+    timer = _timer()
+    if timer is not None:
+        timer._render_started = time.perf_counter()
+
+
+def after_render(sender, template, context, **extra):
+    timer = _timer()
+    if timer is not None and timer._render_started is not None:
+        timer.render_time += time.perf_counter() - timer._render_started
+        timer._render_started = None
+
+
+@bp.record_once
+def install(state=None):
+    """蓝本第一次注册到 app 上时注册 SQLAlchemy 事件和 Flask 信号，同一进程中的多个 app 共用"""
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        before_render_template.connect(before_render)  # 没有开启的 app 的请求中没有计时器，直接跳过
+        template_rendered.connect(after_render)
+        _installed = True
+
+
+@bp.before_app_request
+def start_timer():
+    g._request_timer = RequestTimer()
+
+
+@bp.after_app_request
+def record_timing(response):
+    timer = g.pop('_request_timer', None)
+    if timer is None:
+        return response
+    timing = timer.result()
+    # Server-Timing 头可以直接在浏览器开发者工具的 Network 面板中查看，单位为毫秒
+    response.headers['Server-Timing'] = ', '.join([
+        'db;dur=%.2f;desc="%d queries"' % (timing['db'] * 1000, timing['queries']),
+        'render;dur=%.2f' % (timing['render'] * 1000),
+        'handler;dur=%.2f' % (timing['handler'] * 1000),
+        'total;dur=%.2f' % (timing['total'] * 1000),
+    ])
+    endpoint = request.endpoint or 'unknown'
+    metrics.record(endpoint, timing)
+    logger.info(json.dumps(dict(timing, endpoint=endpoint, method=request.method, path=request.path,
+                                status=response.status_code)))
+    return response
+
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
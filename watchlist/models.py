@@ -1,7 +1,13 @@
+import os
+from collections import namedtuple
+from datetime import datetime, timezone
+
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event
+from sqlalchemy.orm import Bundle
 
 from watchlist import db
+from watchlist.hashing import hash_pool
 
 
 # 借助 SQLAlchemy，可通过定义 Python 类来表示数据库里的一张表（类属性表示表中的字段/列）
@@ -9,17 +15,173 @@ from watchlist import db
 class User(db.Model,UserMixin):  # 模型类声明继承（db.Model）建立一个用户名的表，表名即类名小写
     id = db.Column(db.Integer, primary_key=True)  # primary_key=True表示ID作为主键
     name = db.Column(db.String(20), unique=True, nullable=False)  # 人名为最长20的字符串，不能重复，不能为空
-    username = db.Column(db.String(20))  # 用户名
+    username = db.Column(db.String(20), unique=True, index=True)  # 用户名，登录时按用户名查找
+    movies = db.relationship('Movie', backref='owner', lazy='dynamic')  # 该用户的观影清单
     password_hash = db.Column(db.String(128))  # 密码散列值
 
+    # 按用户分库时数据库文件以用户 id 命名，id 不能被新用户重复使用，否则新用户会打开已删除用户留下的文件；
+    # 已有的数据库需要 flask initdb --drop 重建 user 表后才生效
+    __table_args__ = ({'sqlite_autoincrement': True},)
+
     def set_password(self, password):  # 用来设置密码的方法，接受密码作为参数
-        self.password_hash = generate_password_hash(password)  # 将生成的密码保持到password_hash字段
+        self.password_hash = hash_pool.generate(password)  # 将生成的密码保持到password_hash字段，散列在线程池中计算
 
     def validate_password(self, password):  # 用于验证密码的方法，接受密码作为参数
-        return check_password_hash(self.password_hash, password)
+        return hash_pool.check(self.password_hash, password)
+
+    def password_needs_rehash(self):  # 散列参数已过时（例如调高了计算强度），登录成功后应重新计算
+        return hash_pool.needs_rehash(self.password_hash)
     
 
 class Movie(db.Model):  # 电影标题和上映年份的表
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60))  # 电影标题
-    year = db.Column(db.String(4))  # 上映年份
\ No newline at end of file
+    year = db.Column(db.Integer)  # 上映年份，整数类型才能按数值排序和做范围查询
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # 所属用户，每个用户有自己的观影清单
+
+    __table_args__ = (
+        # 所有查询都限定在一个用户的清单内：WHERE user_id = ? AND id > ? ORDER BY id 只在该用户的索引区间内查找，
+        # 分页和计数的开销只与这个用户的条目数有关，与整张表的大小无关
+        db.Index('ix_movie_user_id_id', 'user_id', 'id'),
+        db.Index('ix_movie_year_id', 'year', 'id'),  # 按年份排序、筛选年份区间时使用
+        db.Index('ix_movie_title_lower', db.func.lower(title)),  # 忽略大小写的标题查找/查重
+    )
+
+
+# 列表页面只读取 id、title 和 year，不需要完整的 Movie 实例：ORM 实例带有属性跟踪和 InstanceState，
+# 还会登记到会话的 identity map 中。只读的行用 namedtuple 保存，只有三个字段，不经过 identity map
+class MovieRow(namedtuple('MovieRow', 'id title year')):
+    __slots__ = ()
+
+
+class MovieRows(Bundle):
+    """查询结果直接构造为 MovieRow"""
+
+    def create_row_processor(self, query, procs, labels):
+        id_, title, year = procs
+        return lambda row: MovieRow(id_(row), title(row), year(row))
+
+
+movie_row = MovieRows('movie', Movie.id, Movie.title, Movie.year, single_entity=True)  # 用法：db.session.query(movie_row)、db.select(movie_row)
+
+
+class Revision(db.Model):  # 只有一行（id=1），记录观影清单的版本号和最后修改时间，用于 ETag/Last-Modified
+    id = db.Column(db.Integer, primary_key=True)
+    revision = db.Column(db.Integer, nullable=False, default=0)  # 每次写操作加一
+    updated_at = db.Column(db.DateTime, nullable=False)  # 最后修改时间（UTC）
+    # 创建这一行时随机生成：initdb --drop 重建数据库后版本号从头开始，ETag 和缓存键中带上它才不会与重建前的相同
+    generation = db.Column(db.String(16), nullable=False, default='', server_default='')
+
+
+def new_generation():
+    return os.urandom(6).hex()
+
+
+@event.listens_for(Revision.__table__, 'after_create')
+def create_revision_row(table, connection, **kwargs):
+    # 新建数据库时就写入版本记录，还没有写操作的新数据库也有自己的 generation，不会与重建前的空数据库相同
+    connection.execute(table.insert().values(id=1, revision=0, updated_at=utcnow(), generation=new_generation()))
+
+
+def upgrade_revision_table(conn):
+    """给旧数据库的 revision 表添加 generation 列，已有的行为空字符串，下次重建数据库时生成"""
+    columns = [row[1] for row in conn.execute(db.text('PRAGMA table_info(revision)'))]
+    if columns and 'generation' not in columns:
+        conn.execute(db.text("ALTER TABLE revision ADD COLUMN generation VARCHAR(16) NOT NULL DEFAULT ''"))
+
+
+class Change(db.Model):  # 变更记录，只追加：每次写操作在同一个事务中记下改了哪些电影，同步客户端按 seq 增量拉取
+    seq = db.Column(db.Integer, primary_key=True)  # 递增的序号，AUTOINCREMENT 保证删除旧记录后也不会重复使用
+    user_id = db.Column(db.Integer, nullable=False)  # 哪个用户的清单（按用户分库时 user 表在主数据库，所以不加外键）
+    kind = db.Column(db.String(10), nullable=False)  # movie 或 user（清单主人改名）
+    op = db.Column(db.String(10), nullable=False)  # insert、update 或 delete（墓碑）
+    object_id = db.Column(db.Integer, nullable=False)  # 电影或用户的 id
+    title = db.Column(db.String(60))  # 写入后的电影标题或用户名字，删除时为空
+    year = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_change_user_id_seq', 'user_id', 'seq'),  # WHERE user_id = ? AND seq > ? ORDER BY seq
+        db.Index('ix_change_object', 'kind', 'object_id', 'seq'),  # 压缩时查找同一对象更新的记录
+        {'sqlite_autoincrement': True},
+    )
+
+
+class ChangeHorizon(db.Model):  # 只有一行（id=1）：压缩时删除的墓碑中最大的 seq，since 比它小的客户端可能漏掉删除，需要全量同步
+    id = db.Column(db.Integer, primary_key=True)
+    seq = db.Column(db.Integer, nullable=False, default=0)
+
+
+@event.listens_for(Change.__table__, 'after_create')
+def seed_changes(table, connection, **kwargs):
+    # 已有电影的旧数据库第一次创建变更表（migrate-schema 或 create_all）时，把现有的电影都记为 insert，
+    # 否则从 since=0 同步的客户端只能拿到之后的变更，又不会收到 resync。
+    # 新数据库的 movie 表此时还不存在或为空；还没有 user_id 列的单用户数据库由 migrate-schema 分配主人时再记录
+    inspector = db.inspect(connection)
+    if inspector.has_table('movie') and 'user_id' in [column['name'] for column in inspector.get_columns('movie')]:
+        record_movie_changes('insert', Movie.__table__.c.user_id.isnot(None), connection)
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)  # HTTP 日期只精确到秒
+
+
+def current_revision():
+    """返回版本记录，按主键查询，只需一次索引查找"""
+    revision = db.session.get(Revision, 1)
+    if revision is None:
+        revision = Revision(id=1, revision=0, updated_at=utcnow(), generation='')  # 还没有写操作的空数据库
+    return revision
+
+
+def bump_revision(connection=None):
+    """在当前事务中把版本号加一，需在 commit 之前调用；Core 批量写入时传入所用的 connection"""
+    executor = connection if connection is not None else db.session
+    table = Revision.__table__
+    result = executor.execute(table.update().where(table.c.id == 1)
+                              .values(revision=table.c.revision + 1, updated_at=utcnow()))
+    if result.rowcount == 0:  # 旧数据库还没有版本记录
+        executor.execute(table.insert().values(id=1, revision=1, updated_at=utcnow(), generation=new_generation()))
+
+
+def record_changes(op, objects, connection=None):
+    """在当前事务中记录 Movie 或 User 对象的变更，需在 commit 之前调用；新建的对象要先 flush 拿到 id"""
+    executor = connection if connection is not None else db.session
+    now = utcnow()
+    rows = []
+    for obj in objects:
+        if isinstance(obj, User):
+            row = {'user_id': obj.id, 'kind': 'user', 'title': obj.name, 'year': None}
+        else:
+            row = {'user_id': obj.user_id, 'kind': 'movie', 'title': obj.title, 'year': obj.year}
+        if op == 'delete':
+            row.update(title=None, year=None)
+        rows.append(dict(row, op=op, object_id=obj.id, created_at=now))
+    if rows:
+        executor.execute(Change.__table__.insert(), rows)
+
+
+def record_movie_changes(op, condition, connection=None):
+    """把满足 condition 的电影记入变更记录（INSERT ... SELECT），Core 批量写入时使用；删除要在 DELETE 之前调用"""
+    executor = connection if connection is not None else db.session
+    movie = Movie.__table__
+    deleted = op == 'delete'
+    columns = [movie.c.user_id, db.literal('movie'), db.literal(op), movie.c.id,
+               db.null() if deleted else movie.c.title, db.null() if deleted else movie.c.year, db.literal(utcnow())]
+    names = ['user_id', 'kind', 'op', 'object_id', 'title', 'year', 'created_at']
+    executor.execute(Change.__table__.insert().from_select(names, db.select(*columns).where(condition)))
+
+
+def validate_title(title):
+    return bool(title) and len(title) <= 60  # 标题不为空且不超过 60 个字符
+
+
+def validate_year(year):
+    # 年份为 4 位数字；isdigit() 也接受 '²' 等 Unicode 数字，int() 转换时会出错，所以先要求是 ASCII；
+    # 表单中没有 year 字段时为 None
+    return year is not None and len(year) == 4 and year.isascii() and year.isdigit()
+
+
+def validate_movie(title, year):
+    """检查电影标题和年份是否符合要求"""
+    return validate_title(title) and validate_year(year)
@@ -0,0 +1,57 @@
+from flask import abort, request
+
+from watchlist import db
+
+SQLITE_INTEGER_MAX = 2 ** 63 - 1  # SQLite INTEGER 是 64 位有符号整数，绑定更大的参数会抛出 OverflowError
+
+# 基于游标（keyset）的分页：用上一页最后一条的 id 作为下一页的起点，
+# 查询条件是 WHERE id > ? ORDER BY id LIMIT n，走主键索引，翻到多深都只读 n 条
+class KeysetPage(object):
+
+    def __init__(self, items, has_prev, has_next):
+        self.items = items
+        self.has_prev = has_prev
+        self.has_next = has_next
+
+    @property
+    def first_id(self):  # 当前页第一条的 id，作为“上一页”链接的 before 参数
+        return self.items[0].id if self.items else None
+
+    @property
+    def last_id(self):  # 当前页最后一条的 id，作为“下一页”链接的 after 参数
+        return self.items[-1].id if self.items else None
+
+
+def keyset_page(query, column, per_page, before=None, after=None):
+    """按 column 升序取一页；after 表示取 column > after 的下一页，before 表示取 column < before 的上一页"""
+    if before is not None:
+        # 往前翻：倒序取 per_page + 1 条，多出来的一条说明前面还有数据，最后再翻转回升序
+        rows = query.filter(column < before).order_by(column.desc()).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_next = _exists(query.filter(column >= before), column)
+        return KeysetPage(rows, has_prev, has_next)
+
+    if after is not None:
+        query_page = query.filter(column > after)
+    else:
+        query_page = query
+    rows = query_page.order_by(column).limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    has_prev = after is not None and _exists(query.filter(column <= after), column)
+    return KeysetPage(rows, has_prev, has_next)
+
+
+def cursor_arg(name):
+    """读取 after/before 等整数游标参数；不是整数时为 None，超出 SQLite INTEGER 范围时返回 400"""
+    value = request.args.get(name, type=int)
+    if value is not None and not -SQLITE_INTEGER_MAX - 1 <= value <= SQLITE_INTEGER_MAX:
+        abort(400, '%s is out of range.' % name)  # API 把说明放在 JSON 的 error 中返回
+    return value
+
+
+def _exists(query, column):
+    # EXISTS 子查询只需在索引上找到一条即可返回，不会扫描整张表
+    # 子查询只选 column，query 查询的是 Bundle（如 movie_row）时也能生成 EXISTS
+    return db.session.query(query.with_entities(column).exists()).scalar()
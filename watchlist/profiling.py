@@ -0,0 +1,200 @@
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Blueprint, current_app, g, request
+
+
+# 慢请求分析，两种方式可以同时开启：
+# 1. WATCHLIST_PROFILE_SAMPLE=N：随机每 N 个请求用 cProfile 完整记录一次，保存为 .prof（pstats 格式）
+# 2. WATCHLIST_PROFILE_SLOW_MS=毫秒：后台线程定时采样正在处理请求的线程的调用栈，
+#    请求耗时超过阈值时把采样结果保存为 .folded（collapsed stack 格式，可直接用 flamegraph.pl 生成火焰图）
+# 文件按 endpoint 分目录保存在 WATCHLIST_PROFILE_DIR 下，超过数量或总大小上限时删除最旧的文件；没有设置该目录时不注册
+bp = Blueprint('profiling', __name__)
+
+
+class StackSampler(object):
+    """定时读取各线程当前的调用栈，只记录登记过的（正在处理请求的）线程"""
+
+    def __init__(self):
+        self._active = {}  # 线程 id -> 该请求的采样计数
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, interval):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, args=(interval,),
+                                                name='request-sampler', daemon=True)
+                self._thread.start()
+
+    def reset(self):
+        """fork 之后在子进程中调用：采样线程不会复制到子进程，下次需要时重新启动"""
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def begin(self):
+        samples = Counter()
+        with self._lock:
+            self._active[threading.get_ident()] = samples
+        return samples
+
+    def end(self):
+        with self._lock:
+            return self._active.pop(threading.get_ident(), None)
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[collapse(frame)] += 1
+
+
+def collapse(frame):
+    """把调用栈转换成 collapsed 格式：从最外层到最内层，用分号连接"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+sampler = StackSampler()
+
+
+def route_dir(endpoint):
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', endpoint or 'unknown')
+    path = os.path.join(current_app.config['WATCHLIST_PROFILE_DIR'], name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def dump_path(endpoint, duration, suffix):
+    filename = '%d-%dms-%d%s' % (time.time() * 1000, duration * 1000, os.getpid(), suffix)
+    return os.path.join(route_dir(endpoint), filename)
+
+
+def rotate():
+    """每个 endpoint 最多保留 WATCHLIST_PROFILE_MAX_FILES 个文件，所有文件总大小不超过 WATCHLIST_PROFILE_MAX_BYTES"""
+    root = current_app.config['WATCHLIST_PROFILE_DIR']
+    files = []
+    for name in os.listdir(root):
+        directory = os.path.join(root, name)
+        if not os.path.isdir(directory):
+            continue
+        entries = sorted(os.path.join(directory, f) for f in os.listdir(directory))  # 文件名以时间戳开头
+        for path in entries[:-current_app.config['WATCHLIST_PROFILE_MAX_FILES']]:
+            _remove(path)
+        files.extend(entries[-current_app.config['WATCHLIST_PROFILE_MAX_FILES']:])
+    files = [(os.path.basename(path), path) for path in files if os.path.exists(path)]
+    total = sum(os.path.getsize(path) for _, path in files)
+    for _, path in sorted(files):  # 从最旧的开始删除
+        if total <= current_app.config['WATCHLIST_PROFILE_MAX_BYTES']:
+            break
+        total -= os.path.getsize(path)
+        _remove(path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:  # 可能已被其他 worker 删除
+        pass
+
+
+@bp.before_app_request
+def start_profiling():
+    g._profile_started = time.perf_counter()
+    sample = current_app.config['WATCHLIST_PROFILE_SAMPLE']
+    if sample and random.randrange(sample) == 0:
+        import cProfile  # 只有开启抽样时才需要
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g._profiler = profiler
+            return
+        except ValueError:
+            # Python 3.12 起 cProfile 基于 sys.monitoring，同一时间只能有一个 Profile 开启，
+            # 其他线程正在记录时这个请求改用调用栈采样（如果开启了的话）
+            pass
+    if current_app.config['WATCHLIST_PROFILE_SLOW_MS']:
+        sampler.start(current_app.config['WATCHLIST_PROFILE_INTERVAL_MS'] / 1000.0)
+        g._stack_samples = sampler.begin()
+
+
+@bp.after_app_request
+def save_profile(response):
+    started = g.pop('_profile_started', None)
+    if started is None:
+        return response
+    duration = time.perf_counter() - started
+    profiler = g.pop('_profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(dump_path(request.endpoint, duration, '.prof'))
+        rotate()
+    elif g.pop('_stack_samples', None) is not None:
+        samples = sampler.end()
+        if samples and duration * 1000 >= current_app.config['WATCHLIST_PROFILE_SLOW_MS']:
+            with open(dump_path(request.endpoint, duration, '.folded'), 'w') as f:
+                for stack, count in samples.items():
+                    f.write('%s %d\n' % (stack, count))
+            rotate()
+    return response
+
+
+@bp.teardown_app_request
+def stop_profiling(exc):
+    # 视图抛出异常时 after_request 不会执行，这里确保线程不再被采样、cProfile 被关闭
+    if g.pop('_stack_samples', None) is not None:
+        sampler.end()
+    profiler = g.pop('_profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+
+def report(root, top):
+    """合并每个 endpoint 的所有分析文件，按自身耗时（.prof，秒）和自身采样数（.folded）分别取前 top 个函数"""
+    import pstats
+
+    results = {}
+    for endpoint in sorted(os.listdir(root)):
+        directory = os.path.join(root, endpoint)
+        if not os.path.isdir(directory):
+            continue
+        paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+        profiles = [path for path in paths if path.endswith('.prof')]
+        timed = []
+        if profiles:
+            stats = pstats.Stats(*profiles)
+            for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+                timed.append(('%s (%s:%d)' % (name, os.path.basename(filename), line), tt, ct))
+            timed.sort(key=lambda row: row[1], reverse=True)
+        own, inclusive = Counter(), Counter()
+        for path in paths:
+            if not path.endswith('.folded'):
+                continue
+            with open(path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    frames = stack.split(';')
+                    own[frames[-1]] += int(count)
+                    for frame in set(frames):
+                        inclusive[frame] += int(count)
+        sampled = sorted(((frame, own[frame], inclusive[frame]) for frame in inclusive),
+                         key=lambda row: row[1], reverse=True)
+        results[endpoint] = {'profiles': len(profiles), 'timed': timed[:top],
+                             'samples': sum(own.values()), 'sampled': sampled[:top]}
+    return results
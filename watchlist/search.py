@@ -0,0 +1,69 @@
+from sqlalchemy import DDL, event, text
+
+from watchlist import db
+from watchlist.models import Movie, movie_row
+
+
+# movie_fts 是 SQLite FTS5 全文索引表，以 movie 表为外部内容（content='movie'），自身只存倒排索引
+# 三个触发器在 movie 表每次增删改时同步更新索引，无论写入来自视图、命令还是直接执行的 SQL。
+# user_id 也作为一列编入索引，查询时用 user_id:"<id>" 限定清单，FTS5 只合并该用户的倒排列表，
+# 不会先匹配出所有用户的条目再过滤。所有用户仍共用一个索引文件（词频统计也是全局的，会略微影响 bm25 排序），
+# 需要完全隔离时使用按用户分库（WATCHLIST_TENANT_DIR）
+SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS movie_fts USING fts5("
+    "title, user_id, content='movie', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_insert AFTER INSERT ON movie BEGIN "
+    "INSERT INTO movie_fts (rowid, title, user_id) VALUES (new.id, new.title, new.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_delete AFTER DELETE ON movie BEGIN "
+    "INSERT INTO movie_fts (movie_fts, rowid, title, user_id) VALUES ('delete', old.id, old.title, old.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_update AFTER UPDATE OF title, user_id ON movie BEGIN "
+    "INSERT INTO movie_fts (movie_fts, rowid, title, user_id) VALUES ('delete', old.id, old.title, old.user_id); "
+    "INSERT INTO movie_fts (rowid, title, user_id) VALUES (new.id, new.title, new.user_id); END",
+]
+
+# db.create_all() 新建 movie 表时一并创建索引表和触发器，drop_all() 时一并删除
+for statement in SEARCH_DDL:
+    event.listen(Movie.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Movie.__table__, 'after_drop', DDL('DROP TABLE IF EXISTS movie_fts').execute_if(dialect='sqlite'))
+
+
+def create_search_index(conn):
+    """为已有的数据库创建索引表和触发器（已存在的会跳过），之后需要调用 rebuild_search_index()
+
+    旧版本创建的索引没有 user_id 列，先删除索引表和触发器再按新结构创建
+    """
+    columns = [row[1] for row in conn.execute(text('PRAGMA table_info(movie_fts)'))]
+    if columns and 'user_id' not in columns:
+        for name in ('insert', 'delete', 'update'):
+            conn.execute(text('DROP TRIGGER IF EXISTS movie_fts_%s' % name))
+        conn.execute(text('DROP TABLE movie_fts'))
+    for statement in SEARCH_DDL:
+        conn.execute(text(statement))
+
+
+def rebuild_search_index(conn):
+    """根据 movie 表的当前内容重建整个全文索引"""
+    conn.execute(text("INSERT INTO movie_fts (movie_fts) VALUES ('rebuild')"))
+
+
+def match_expression(query):
+    # 把用户输入拆成词，每个词加引号按短语处理并允许前缀匹配，
+    # 避免输入中的引号、AND/OR/NOT 等被当作 FTS5 语法导致查询出错
+    terms = ['"%s"*' % term.replace('"', '""') for term in query.split()]
+    return ' '.join(terms)
+
+
+def search_movies(query, page, per_page, user_id):
+    """在 user_id 的清单中搜索，按相关度（bm25）排序返回第 page 页的结果和匹配总数"""
+    expression = match_expression(query)
+    if not expression:
+        return [], 0
+    # 用户输入的词只匹配 title 列，user_id 列按完整的词匹配（"1" 不会匹配到 "12"）
+    params = {'q': 'user_id : "%d" AND title : (%s)' % (user_id, expression),
+              'n': per_page, 'offset': (page - 1) * per_page}
+    matches = 'FROM movie_fts WHERE movie_fts MATCH :q'
+    ids = db.session.execute(text('SELECT movie_fts.rowid ' + matches + ' ORDER BY rank LIMIT :n OFFSET :offset'),
+                             params).scalars().all()
+    total = db.session.execute(text('SELECT count(*) ' + matches), params).scalar()
+    movies = dict((movie.id, movie) for movie in db.session.query(movie_row).filter(Movie.id.in_(ids)))
+    return [movies[movie_id] for movie_id in ids if movie_id in movies], total
@@ -0,0 +1,66 @@
+import random
+import time
+from functools import wraps
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool, StaticPool
+
+# 生产环境的 SQLite 参数：WAL 模式下读操作不会被写操作阻塞，写操作也不会被读操作阻塞
+PRODUCTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # WAL 模式下 NORMAL 已能保证数据库不损坏，只在断电时可能丢失最后的事务
+    'cache_size': -20000,  # 负数单位为 KiB，即每个连接约 20 MB 页缓存
+    'mmap_size': 268435456,  # 用 256 MB 内存映射读取数据库文件，减少系统调用
+    'temp_store': 'MEMORY',  # 排序、临时索引放在内存中
+    'busy_timeout': 5000,  # 遇到锁时最多等待 5 秒，而不是立即报 database is locked
+}
+
+PROFILES = {
+    'production': PRODUCTION_PRAGMAS,
+    'default': {},  # 使用 SQLite 自身的默认设置
+}
+
+
+def engine_options(uri, pool_size):
+    """根据数据库地址选择连接池：内存数据库只能共享一个连接，文件数据库使用连接池复用连接"""
+    if uri.startswith('sqlite') and (uri.endswith(':memory:') or uri.rstrip('/') == 'sqlite:'):
+        return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+    return {'poolclass': QueuePool, 'pool_size': pool_size, 'max_overflow': pool_size * 2,
+            'connect_args': {'check_same_thread': False}}
+
+
+def apply_pragmas(engine, pragmas):
+    """给 engine 的每个新连接执行 PRAGMA 设置"""
+    if not pragmas or engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+
+def is_busy_error(error):
+    message = str(error.orig) if getattr(error, 'orig', None) is not None else str(error)
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def retry_on_busy(func):
+    """装饰器：数据库被其他写操作锁住（SQLITE_BUSY）时回滚，并按指数退避重试整个函数"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        from watchlist import db
+        retries = current_app.config['WATCHLIST_DB_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if attempt == retries or not is_busy_error(e):
+                    raise
+                db.session.rollback()
+                time.sleep(0.05 * (2 ** attempt) * (0.5 + random.random()))  # 加随机抖动，避免多个请求同时重试
+    return wrapper
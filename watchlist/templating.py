@@ -0,0 +1,94 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+
+from watchlist import current_owner_id
+
+# 模板字节码缓存：每个 worker 第一次用到模板时都要把它编译成 Python 代码，worker 多、重启频繁时第一个请求明显变慢。
+# 编译结果保存在 WATCHLIST_TEMPLATE_CACHE_DIR 中，所有 worker 共用，模板源文件变了会自动重新编译；
+# 部署时执行 flask compile-templates 预先编译全部模板
+
+
+def init_app(app):
+    """设置字节码缓存和模板全局函数；必须在第一次访问 app.jinja_env 之前调用，所以 create_app() 最先调用它"""
+    if app.config['WATCHLIST_TEMPLATE_CACHE_DIR']:
+        os.makedirs(app.config['WATCHLIST_TEMPLATE_CACHE_DIR'], exist_ok=True)
+        app.jinja_options = dict(app.jinja_options,
+                                 bytecode_cache=FileSystemBytecodeCache(app.config['WATCHLIST_TEMPLATE_CACHE_DIR']))
+    # 模板中用 {% call static_fragment('head') %}...{% endcall %} 包住不变的部分
+    app.jinja_env.globals['static_fragment'] = fragment_cache.render
+
+
+def compile_templates():
+    """编译所有模板并写入字节码缓存，返回模板名列表"""
+    names = current_app.jinja_env.list_templates()
+    for name in names:
+        current_app.jinja_env.get_template(name)
+    return names
+
+
+_template_tokens = {}  # (WATCHLIST_BUILD_ID, 模板目录) -> 模板文件的摘要
+
+
+def build_token():
+    """部署版本：WATCHLIST_BUILD_ID、模板文件或静态资源的 manifest 变化后随之改变
+
+    ETag 和整页缓存的键中包含它，部署新模板或重新构建静态资源后，浏览器和缓存不会继续使用旧页面。
+    同一次部署的所有 worker 计算出的值相同。
+    """
+    key = (current_app.config['WATCHLIST_BUILD_ID'], current_app.template_folder)
+    template_token = _template_tokens.get(key)
+    if template_token is None:  # 模板只在部署时变化，每个进程计算一次
+        digest = hashlib.sha1(key[0].encode('utf-8'))
+        for directory, dirnames, filenames in sorted(os.walk(os.path.join(current_app.root_path, key[1]))):
+            for filename in sorted(filenames):
+                stat = os.stat(os.path.join(directory, filename))
+                digest.update(('%s:%d:%d;' % (filename, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+        template_token = _template_tokens[key] = digest.hexdigest()
+    from watchlist.assets import manifest
+    return hashlib.sha1(('%s:%s' % (template_token, manifest.version())).encode('utf-8')).hexdigest()[:10]
+
+
+class FragmentCache(object):
+    """base.html 中不随请求变化的部分（页头、标题、页脚）每个清单版本只渲染一次
+
+    内容取决于清单主人（名字）、静态资源的 manifest（文件地址）和清单版本号（修改名字也会更新版本号），
+    前两者作为键，版本号和渲染结果一起保存，版本号变化后重新渲染
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, name, caller):
+        if not current_app.config['WATCHLIST_TEMPLATE_FRAGMENTS']:
+            return caller()
+        from watchlist.assets import manifest
+        from watchlist.models import current_revision
+        revision = current_revision()  # conditional() 已经查询过，这里从会话的 identity map 中取得
+        revision = (revision.revision, revision.generation)  # 重建的数据库（或同一进程中的另一个 app）版本号会重复
+        key = (name, current_owner_id(), manifest.version())
+        with self._lock:
+            cached = self._fragments.get(key)
+            if cached is not None and cached[0] == revision:
+                self._fragments.move_to_end(key)
+                return cached[1]
+        fragment = caller()
+        with self._lock:
+            self._fragments[key] = (revision, fragment)
+            self._fragments.move_to_end(key)
+            while len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+        return fragment
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+
+fragment_cache = FragmentCache()
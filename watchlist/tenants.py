@@ -0,0 +1,171 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from flask import current_app, g, has_app_context, has_request_context
+from flask_sqlalchemy.session import Session
+
+from watchlist.sqlite import PROFILES, apply_pragmas, engine_options
+
+# 按用户分库：设置 WATCHLIST_TENANT_DIR 后，每个用户的电影和版本记录保存在该目录下各自的 <user_id>.db 中，
+# 只有 user 表留在主数据库（登录时按用户名查找）。不同用户的写操作不再争用同一个数据库锁，
+# 迁移某个用户只需要移动一个文件。打开的 engine 放在有上限的 LRU 中，按需创建，被淘汰时关闭连接。
+# 会话在一个事务内始终使用第一次取得的 engine：事务进行中 engine 被其他请求挤出 LRU 时，
+# 如果改用新建的 engine，同一个会话会对同一个文件持有两个连接，第二个连接永远等不到第一个连接的写锁
+
+GLOBAL_TABLES = ('user',)  # 留在主数据库中的表
+
+
+def tenant_mode():
+    return bool(current_app.config['WATCHLIST_TENANT_DIR'])
+
+
+def tenant_path(tenant_id):
+    return os.path.join(current_app.config['WATCHLIST_TENANT_DIR'], '%d.db' % tenant_id)
+
+
+class TenantEngines(object):
+    """数据库文件路径 -> engine 的 LRU 缓存；按路径而不是用户 id 区分，同一进程中的多个 app 可以使用不同的目录"""
+
+    def __init__(self):
+        self._engines = OrderedDict()
+        self._retired = []  # 已被淘汰、但仍有连接在事务中使用的 engine
+        self._lock = threading.Lock()
+
+    def get(self, tenant_id):
+        path = tenant_path(tenant_id)
+        with self._lock:
+            engine = self._engines.get(path)
+            if engine is not None:
+                self._engines.move_to_end(path)
+                return engine
+            engine = self._engines[path] = self._open(path)
+            while len(self._engines) > current_app.config['WATCHLIST_TENANT_ENGINES']:
+                self._retired.append(self._engines.popitem(last=False)[1])
+            # 连接都已归还的 engine 才关闭，还在使用的留到下次淘汰时再检查
+            idle = [old for old in self._retired if old.pool.checkedout() == 0]
+            self._retired = [old for old in self._retired if old.pool.checkedout() > 0]
+        for old in idle:
+            old.dispose()
+        return engine
+
+    def _open(self, path):
+        from watchlist import db
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        uri = 'sqlite:///' + path
+        engine = sa.create_engine(uri, **engine_options(uri, current_app.config['WATCHLIST_TENANT_POOL_SIZE']))
+        apply_pragmas(engine, PROFILES[current_app.config['WATCHLIST_DB_PROFILE']])
+        # 第一次打开时建表（包括全文索引），已存在的表会跳过
+        db.metadata.create_all(engine, tables=tenant_tables())
+        from watchlist.models import upgrade_revision_table
+        with engine.begin() as conn:
+            upgrade_revision_table(conn)
+        return engine
+
+    def drop(self, tenant_id):
+        """删除该用户的所有表，用于 initdb --drop"""
+        from watchlist import db
+        db.metadata.drop_all(self.get(tenant_id), tables=tenant_tables())
+
+    def purge(self):
+        """关闭所有 engine 并删除目录下所有用户的数据库文件，用于 initdb --drop：
+        重建的 user 表从 1 开始分配 id，留下的文件会被新用户当作自己的数据库打开"""
+        self.clear()
+        root = current_app.config['WATCHLIST_TENANT_DIR']
+        if not os.path.isdir(root):
+            return 0
+        removed = 0
+        for name in os.listdir(root):
+            match = re.match(r'^\d+\.db(-wal|-shm|-journal)?$', name)
+            if match:
+                os.remove(os.path.join(root, name))
+                removed += not match.group(1)
+        return removed
+
+    def clear(self):
+        with self._lock:
+            engines = list(self._engines.values()) + self._retired
+            self._engines.clear()
+            self._retired = []
+        for engine in engines:
+            engine.dispose()
+
+    def reset(self):
+        """fork 之后在子进程中调用：丢弃继承来的 engine，不关闭父进程仍在使用的连接"""
+        engines = list(self._engines.values()) + self._retired
+        self._engines = OrderedDict()
+        self._retired = []
+        self._lock = threading.Lock()
+        for engine in engines:
+            engine.dispose(close=False)
+
+    def __len__(self):
+        return len(self._engines)
+
+
+tenant_engines = TenantEngines()
+
+
+def tenant_tables():
+    from watchlist import db
+    return [table for table in db.metadata.sorted_tables if table.name not in GLOBAL_TABLES]
+
+
+def current_tenant():
+    """当前操作的用户：命令中由 tenant_scope() 指定，请求中是当前清单的主人"""
+    tenant_id = g.get('_tenant_id') if has_app_context() else None
+    if tenant_id is None and has_request_context():
+        from watchlist import current_owner_id
+        tenant_id = current_owner_id() or None  # 还没有用户时使用主数据库
+    return tenant_id
+
+
+@contextmanager
+def tenant_scope(tenant_id):
+    """在 with 代码块内把数据库操作路由到 tenant_id 的数据库，需在 commit 之后才退出"""
+    previous = g.get('_tenant_id')
+    g._tenant_id = tenant_id
+    try:
+        yield
+    finally:
+        g._tenant_id = previous
+
+
+def tenant_engine(tenant_id):
+    """Core 批量写入（如 import 命令）使用的 engine"""
+    from watchlist import db
+    return tenant_engines.get(tenant_id) if tenant_mode() else db.engine
+
+
+def _is_global(mapper, clause):
+    if mapper is not None:
+        return sa.inspect(mapper).local_table.name in GLOBAL_TABLES
+    if isinstance(clause, sa.Table):
+        return clause.name in GLOBAL_TABLES
+    if isinstance(clause, sa.sql.dml.UpdateBase) and isinstance(clause.table, sa.Table):
+        return clause.table.name in GLOBAL_TABLES
+    return False
+
+
+class TenantSession(Session):
+    """按用户分库时，除 user 表以外的查询和写入都发往当前用户的数据库"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and tenant_mode() and not _is_global(mapper, clause):
+            tenant_id = current_tenant()
+            if tenant_id is not None:
+                # 同一个事务内复用第一次取得的 engine，即使它已被挤出 LRU
+                engines = self.info.setdefault('tenant_engines', {})
+                if tenant_id not in engines:
+                    engines[tenant_id] = tenant_engines.get(tenant_id)
+                return engines[tenant_id]
+        return super(TenantSession, self).get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@sa.event.listens_for(TenantSession, 'after_transaction_end')
+def release_tenant_engines(session, transaction):
+    if transaction.parent is None:  # 最外层事务结束后，下一个事务重新从 LRU 取得 engine
+        session.info.pop('tenant_engines', None)
@@ -1,100 +1,267 @@
-from flask import render_template, request, url_for, redirect, flash
+from datetime import timezone
+from functools import wraps
+
+from flask import Blueprint, abort, current_app, render_template, stream_template, request, session, url_for, redirect, flash, make_response, Response, stream_with_context
 from flask_login import login_user, login_required, logout_user, current_user
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.http import is_resource_modified
+from sqlalchemy import bindparam
+
+from watchlist import db, current_owner_id
+from watchlist.cache import page_cache, user_cache
+from watchlist.export import export_chunks, gzip_chunks
+from watchlist.hashing import HashingBusy
+from watchlist.models import User, Movie, movie_row, validate_movie, validate_title, validate_year, bump_revision, current_revision, record_changes, record_movie_changes
+from watchlist.pagination import SQLITE_INTEGER_MAX, cursor_arg, keyset_page
+from watchlist.search import search_movies
+from watchlist.sqlite import retry_on_busy
+from watchlist.templating import build_token
+
+# 网页部分：主页、搜索、编辑和登录等页面，在 create_app() 中注册到 app 上
+bp = Blueprint('main', __name__)
 
-from watchlist import app, db
-from watchlist.models import User, Movie
 
+def conditional(view):
+    """视图装饰器：根据清单版本号生成 ETag/Last-Modified，浏览器缓存仍然有效时直接返回 304，不查询电影也不渲染模板"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or session.get('_flashes'):  # flash 消息只显示一次，页面内容会不同
+            return view(*args, **kwargs)
+        revision = current_revision()
+        # 页面内容还取决于是否登录（导航栏、编辑按钮）和部署的模板、静态资源，所以 ETag 中包含当前用户和部署版本；
+        # 重建数据库后版本号从头开始，generation 不同，旧的 ETag 不会再匹配
+        etag = '%d-%s-%s-%s' % (revision.revision, revision.generation, current_user.get_id() or 'anonymous',
+                                build_token())
+        last_modified = revision.updated_at.replace(tzinfo=timezone.utc)
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True  # 允许缓存，但每次使用前都要向服务器确认
+        if current_user.is_authenticated:
+            response.cache_control.private = True
+        return response
+    return wrapper
 
 # GET 请求用来获取资源，而 POST 则用来创建 / 更新资源；访问链接时会发送 GET 请求，提交表单会发送 POST 请求
-# app.route() 里，可用 methods 关键字传递一个包含 HTTP 方法字符串的列表，表示这个视图函数处理哪种方法类型的请求
+# bp.route() 里，可用 methods 关键字传递一个包含 HTTP 方法字符串的列表，表示这个视图函数处理哪种方法类型的请求
 # 默认只接受 GET 请求，methods=['GET','POST']表示同时接受 GET 和 POST 请求，针对不同请求采用不同方法
-@app.route('/',methods=['GET','POST'])  # 定义了methods后，index.html POST 的表单就能被视图函数正确读取
+@bp.route('/',methods=['GET','POST'])  # 定义了methods后，index.html POST 的表单就能被视图函数正确读取
+@conditional  # 内容未变化时返回 304
+@page_cache.cached  # 未登录访客的 GET 请求直接返回缓存的页面
+@retry_on_busy  # 写入时数据库被锁则重试
 def index():
     if request.method == 'POST':  # 判断请求类型
         if not current_user.is_authenticated:  # 如果当前用户未认证
-            return redirect(url_for('index'))  # 重定向到主页，不允许未登录用户创建 item
+            return redirect(url_for('.index'))  # 重定向到主页，不允许未登录用户创建 item
         title = request.form.get('title')
         year = request.form.get('year')  # 将request的表单数据分别放入title和year
-        if len(title) > 60 or len(year) != 4 or not title or not year:  # 判断数据是否有误
+        if not validate_movie(title, year):  # 判断数据是否有误
             flash('Invalid input.')  # flash() 函数用来在视图函数里向模板传递提示消息
-            return redirect(url_for('index'))  # 重定向回首页
-        movie = Movie(title=title, year=year)  # 数据格式无误，加入数据库
+            return redirect(url_for('.index'))  # 重定向回首页
+        movie = Movie(title=title, year=int(year), user_id=current_user.id)  # 数据格式无误，加入当前用户的清单
         db.session.add(movie)
+        db.session.flush()  # 先写入拿到 id，变更记录中要用
+        record_changes('insert', [movie])  # 变更记录与新条目在同一个事务中提交
+        bump_revision()  # 更新清单版本号，与新条目在同一个事务中提交
         db.session.commit()
         flash('Item created.')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     # request请求为默认GET时，渲染index.html
-    movies = Movie.query.all()
+    if current_app.config['WATCHLIST_STREAM_INDEX']:
+        return stream_index()
+    # 按 id 游标分页，?after=<id> 取下一页，?before=<id> 取上一页，只读取当前页的数据
+    page = keyset_page(owned_rows(), Movie.id, current_app.config['WATCHLIST_PER_PAGE'],
+                       before=cursor_arg('before'), after=cursor_arg('after'))
+    total = owned_movies().with_entities(db.func.count(Movie.id)).scalar()  # 总数用 COUNT 查询，不需要取出全部条目
+    prev_url = url_for('.index', before=page.first_id) if page.has_prev else None
+    next_url = url_for('.index', after=page.last_id) if page.has_next else None
     # 左边的 movies 是模版中使用的变量名称，将定义的虚拟数据传入index.html
-    return render_template('index.html', movies=movies)
+    return render_template('index.html', movies=page.items, total=total, prev_url=prev_url, next_url=next_url)
+
+def owned_movies(user_id=None):
+    """当前清单主人的电影查询，走 (user_id, id) 索引"""
+    if user_id is None:
+        user_id = current_owner_id()
+    return Movie.query.filter(Movie.user_id == user_id)
+
+def owned_rows(user_id=None):
+    """与 owned_movies() 相同，但只取出只读的 MovieRow，列表页面使用"""
+    if user_id is None:
+        user_id = current_owner_id()
+    return db.session.query(movie_row).filter(Movie.user_id == user_id)
+
+def stream_index():
+    # yield_per 让查询按批从游标取行，模板边渲染边发送，页头和导航会先到达浏览器
+    movies = owned_rows().order_by(Movie.id).yield_per(current_app.config['WATCHLIST_STREAM_BATCH'])
+    total = owned_movies().with_entities(db.func.count(Movie.id)).scalar()
+    return stream_template('index.html', movies=movies, total=total)
+
+@bp.route('/search')  # 全文搜索电影标题，结果按相关度排序
+@page_cache.cached
+def search():
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['WATCHLIST_PER_PAGE']
+    if (page - 1) * per_page > SQLITE_INTEGER_MAX:  # OFFSET 超出 SQLite INTEGER 范围
+        abort(400)
+    movies, total = search_movies(query, page, per_page, current_owner_id())
+    prev_url = url_for('.search', q=query, page=page - 1) if page > 1 else None
+    next_url = url_for('.search', q=query, page=page + 1) if page * per_page < total else None
+    return render_template('index.html', movies=movies, total=total, query=query,
+                           prev_url=prev_url, next_url=next_url)
 
 # 注意methods=[]对应列表，method=''对应单种HTTP方法
-@app.route('/movie/edit/<int:movie_id>', methods=['GET','POST'])  # <int> 将传入的movie_id转为整型，合并为URL一部分
+@bp.route('/movie/edit/<int:movie_id>', methods=['GET','POST'])  # <int> 将传入的movie_id转为整型，合并为URL一部分
 @login_required  # 添加后未登录的用户访问对应的 URL，Flask-Login 会把用户重定向到登录页面，并显示一个错误提示
+@conditional
+@retry_on_busy
 def edit(movie_id):
-    movie = Movie.query.get_or_404(movie_id)  # 从request中获取要编辑的movie_id，若没找到则返回404错误
+    movie = owned_movies(current_user.id).filter_by(id=movie_id).first_or_404()  # 只能编辑自己的条目，其他用户的条目返回404
     if request.method == 'POST':
         title = request.form['title']  # 从request中取出新的title和year
         year = request.form['year']
-        if len(title) > 60 or len(year) != 4 or not title or not year:  # 判断新数据是否符合数据库的要求
+        if not validate_movie(title, year):  # 判断新数据是否符合数据库的要求
             flash('Invalid input.')
-            return redirect(url_for('edit',movie_id=movie_id))  # 数据格式有误，重定向回编辑页面
+            return redirect(url_for('.edit',movie_id=movie_id))  # 数据格式有误，重定向回编辑页面
         movie.title = title
-        movie.year = year  # movie从Movie中取出来后，movie的title和year变化了，commit之后数据库中对应的元素也变化了
+        movie.year = int(year)  # movie从Movie中取出来后，movie的title和year变化了，commit之后数据库中对应的元素也变化了
+        record_changes('update', [movie])
+        bump_revision()
         db.session.commit()
         flash('Item updated.')  # 提示已完成编辑
-        return redirect(url_for('index'))  # 编辑完成，返回index页面
+        return redirect(url_for('.index'))  # 编辑完成，返回index页面
         
     return render_template('edit.html', movie=movie)  # 无论渲染
 
-@app.route('/movie/delete/<int:movie_id>',methods=['POST'])  # # 限定只接受 POST 请求
+@bp.route('/movie/delete/<int:movie_id>',methods=['POST'])  # # 限定只接受 POST 请求
 @login_required
+@retry_on_busy
 def delete(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
+    movie = owned_movies(current_user.id).filter_by(id=movie_id).first_or_404()
     db.session.delete(movie)
+    record_changes('delete', [movie])  # 删除留下墓碑，同步的客户端据此删除本地的条目
+    bump_revision()
     db.session.commit()
     flash('Item deleted')
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
+
+BATCH_PARAMETERS = 900  # 批量删除时每条 DELETE 语句最多包含的 id 数
+
+# 批量删除/修改：主页勾选多个条目后一次提交，所有改动在同一个事务中完成
+# 删除用 DELETE ... WHERE id IN (...)，修改用一条 UPDATE 语句 executemany，不再每个条目一次请求、一次提交
+@bp.route('/movie/batch', methods=['POST'])
+@login_required
+@retry_on_busy
+def batch():
+    ids = request.form.getlist('ids', type=int)
+    action = request.form.get('action')
+    if not ids or action not in ('delete', 'update'):
+        flash('Invalid input.')
+        return redirect(url_for('.index'))
+    table = Movie.__table__
+    if action == 'delete':
+        count = 0
+        for start in range(0, len(ids), BATCH_PARAMETERS):  # 旧版 SQLite 每条语句最多 999 个参数，超出时分成几条语句，仍在同一事务中
+            condition = db.and_(table.c.user_id == current_user.id, table.c.id.in_(ids[start:start + BATCH_PARAMETERS]))
+            record_movie_changes('delete', condition)  # 在删除之前写入墓碑，只包括确实属于当前用户的条目
+            count += db.session.execute(table.delete().where(condition)).rowcount
+    else:
+        rows = []
+        for movie_id in ids:
+            # 每个条目可以单独提交 title-<id>/year-<id>，没有时使用共用的 title/year；都没有的字段保持不变
+            title = request.form.get('title-%d' % movie_id) or request.form.get('title') or None
+            year = request.form.get('year-%d' % movie_id) or request.form.get('year') or None
+            # 与 edit() 相同的校验规则，任何一个条目不合格则全部不修改
+            if (title is None and year is None) or (title is not None and not validate_title(title)) \
+                    or (year is not None and not validate_year(year)):
+                flash('Invalid input.')
+                return redirect(url_for('.index'))
+            rows.append({'movie_id': movie_id, 'new_title': title, 'new_year': None if year is None else int(year)})
+        statement = (table.update()
+                     .where(table.c.user_id == current_user.id, table.c.id == bindparam('movie_id'))
+                     .values(title=db.func.coalesce(bindparam('new_title', type_=table.c.title.type), table.c.title),
+                             year=db.func.coalesce(bindparam('new_year', type_=table.c.year.type), table.c.year)))
+        count = db.session.execute(statement, rows).rowcount
+        for start in range(0, len(ids), BATCH_PARAMETERS):  # 记下修改后的标题和年份
+            record_movie_changes('update', db.and_(table.c.user_id == current_user.id,
+                                                   table.c.id.in_(ids[start:start + BATCH_PARAMETERS])))
+    bump_revision()
+    db.session.commit()
+    flash('%d items %s.' % (count, 'deleted' if action == 'delete' else 'updated'))
+    return redirect(url_for('.index'))
+
+# 导出整个观影清单，?gzip=1 时输出 gzip 压缩的文件
+# 内容边查询边发送（分块传输），导出再大的清单也不会在内存中拼出完整内容
+@bp.route('/export.<any(csv, jsonl):fmt>')
+def export(fmt):
+    chunks = export_chunks(fmt, current_owner_id())
+    filename = 'watchlist.' + fmt
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    if request.args.get('gzip', type=int):
+        chunks = gzip_chunks(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
 
-@app.route('/login',methods=['GET','POST'])  # 用户登录
+@bp.route('/login',methods=['GET','POST'])  # 用户登录
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         if not username or not password:
             flash('Invalid input.')
-            return redirect(url_for('login'))
-        user = User.query.first()
-        if username == user.username and user.validate_password(password):  # 验证用户名和密码
+            return redirect(url_for('.login'))
+        user = User.query.filter_by(username=username).first()  # 按用户名查找，username 列有唯一索引
+        try:
+            valid = user is not None and user.validate_password(password)  # 验证密码
+        except HashingBusy:  # 同时登录的请求太多，让客户端稍后再试
+            raise TooManyRequests(retry_after=1)
+        if valid:
+            if user.password_needs_rehash():  # 散列参数已过时，趁有明文密码时按新参数重新计算
+                try:
+                    user.set_password(password)
+                    db.session.commit()
+                    user_cache.invalidate(user)
+                except HashingBusy:  # 线程池繁忙时跳过，下次登录再升级
+                    pass
             login_user(user)  # 用户登入
             flash('Login success.')
-            return redirect(url_for('index'))  # 重定向到主页 
+            return redirect(url_for('.index'))  # 重定向到主页 
         flash('Invalid username or password.')  # 如果验证失败，显示错误消息
-        return redirect(url_for('login'))  # 重定向回登录页面
+        return redirect(url_for('.login'))  # 重定向回登录页面
     return render_template('login.html')  # HTTP 方法为 GET 时，仅渲染页面
 
 # login——required 意思是要求必须登录了才能执行下去，
 # 有些页面或 URL 不允许未登录的用户访问，比如登出页面，或页面上有些内容则需要对未登陆的用户隐藏，比如登出按钮
-@app.route('/logout')  # 用户登出
+@bp.route('/logout')  # 用户登出
 @login_required  # 用于视图保护
 def logout():
     logout_user()  # 登出用户
     flash('Goodbye.')
-    return redirect(url_for('index'))  # 重定向回首页
+    return redirect(url_for('.index'))  # 重定向回首页
 
-@app.route('/settings', methods=['GET', 'POST'])  # 已登录用户修改用户名
+@bp.route('/settings', methods=['GET', 'POST'])  # 已登录用户修改用户名
 @login_required
+@retry_on_busy
 def settings():
     if request.method == 'POST':
         name = request.form['name']
         if not name or len(name) > 20:
             flash('Invalid input.')
-            return redirect(url_for('settings'))
+            return redirect(url_for('.settings'))
         current_user.name = name  # current_user 会返回当前登录用户的数据库记录对象
         # 等同于下面的用法
         # user = User.query.first()
         # user.name = name
+        record_changes('update', [current_user._get_current_object()])  # 同步的客户端也显示清单主人的名字
+        bump_revision()
         db.session.commit()
+        user_cache.invalidate(current_user)  # 用户名已修改，清除缓存的旧记录
         flash('Settings updated.')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     return render_template('settings.html')
\ No newline at end of file